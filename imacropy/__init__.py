@@ -9,9 +9,14 @@
 
 - ``macropy3``, a generic bootstrapper for macro-enabled Python programs.
   Use macros in your main program.
+
+- ``imacropy.expand_and_compile``, macro-expand and compile source code with
+  explicitly given macro bindings, with a code object cache. Embed macro-enabled
+  Python in an application.
 """
 
 __version__ = '0.3.2'
 
 # export
 from .util import *
+from .compiler import *
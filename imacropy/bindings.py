@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""Macro binding registry for the REPL consoles.
+
+Both `imacropy.console.MacroConsole` and the IPython extension `imacropy.iconsole`
+keep track of which macros are currently imported into the session. This module
+provides the shared registry for that.
+
+The registry does **not** hold references to the macro modules themselves.
+It stores only the module name and the macro names bound from it, and looks up
+the module in `sys.modules` when the bindings are needed. Each time a macro module
+is reloaded, the registry records a new *version* of that module (identified by
+the module's `macros` object, which the reload replaces), and keeps only weak
+references to the previous versions. Hence, when the stubs in the user namespace
+are refreshed, superseded versions of the macro definitions (along with any
+closures and data they hold) are released, instead of piling up over a long session.
+
+Anything that still keeps a superseded version alive (e.g. ``f = some_macro``
+in the user namespace) shows up in the memory report, see `MacroBindings.memory_report`.
+"""
+
+__all__ = ["MacroBindings"]
+
+import gc
+import importlib
+import sys
+import weakref
+from collections import OrderedDict
+from types import FrameType, ModuleType
+
+from . import catalog, events
+from .util import _source_stamp
+
+class MacroBindings:
+    """Macros currently imported into a REPL session, by module.
+
+    Iterating with `items()` yields ``(fullname, (mod, macro_bindings))``,
+    and `values()` yields ``(mod, macro_bindings)``, which is the format
+    `macropy.core.macros.ModuleExpansionContext` expects.
+
+    `macro_bindings` is a list of ``(name, asname)`` pairs, as returned
+    by `macropy.core.macros.detect_macros`.
+    """
+    def __init__(self):
+        self._bindings = OrderedDict()  # fullname -> macro_bindings
+        self._versions = OrderedDict()  # fullname -> [(version_number, [weakref, ...]), ...], latest last
+        self._stamps = {}  # fullname -> source stamp of latest version
+
+    def __bool__(self):
+        return bool(self._bindings)
+
+    def __len__(self):
+        return len(self._bindings)
+
+    def __contains__(self, fullname):
+        return fullname in self._bindings
+
+    def items(self):
+        """Yield ``(fullname, (mod, macro_bindings))`` for each bound macro module."""
+        for fullname, macro_bindings in self._bindings.items():
+            mod = sys.modules.get(fullname)
+            if mod is None:  # removed from sys.modules behind our back
+                continue
+            yield fullname, (mod, macro_bindings)
+
+    def values(self):
+        """Yield ``(mod, macro_bindings)`` for each bound macro module."""
+        for _, value in self.items():
+            yield value
+
+    def commit(self, bindings):
+        """Validate and commit new bindings, as returned by `detect_macros`.
+
+        The set of macros bound from a given module is replaced by the most
+        recent import from that module.
+
+        If any macro name does not exist in its module, raise `ImportError`
+        without changing the registry.
+        """
+        for fullname, macro_bindings in bindings:  # validate before committing
+            mod = importlib.import_module(fullname)  # already imported so just a sys.modules lookup
+            for origname, _ in macro_bindings:
+                try:
+                    getattr(mod, origname)
+                except AttributeError:
+                    raise ImportError(f"cannot import name '{origname}'")
+        for fullname, macro_bindings in bindings:
+            self._bindings[fullname] = macro_bindings
+            self.note_version(fullname)
+            events.record("bind", module=fullname, names=[asname for _, asname in macro_bindings])
+
+    def note_reload(self, fullnames):
+        """Record new versions of reloaded macro modules.
+
+        `fullnames` are the modules that were just reloaded; those that are not
+        currently bound are ignored.
+
+        Return whether any bound module got a new version (in which case the
+        caller should refresh its macro stubs).
+        """
+        changed = [self.note_version(fullname) for fullname in fullnames if fullname in self._bindings]
+        return any(changed)
+
+    def note_version(self, fullname):
+        """Record the current version of macro module `fullname`.
+
+        Call this after (re)loading the module. If the module's `macros` object
+        has changed since the last recorded version, a new version is recorded,
+        and the previous ones become superseded.
+
+        Return whether a new version was recorded.
+        """
+        mod = sys.modules.get(fullname)
+        registry = getattr(mod, "macros", None)
+        if registry is None:
+            return False
+        versions = self._versions.setdefault(fullname, [])
+        if versions:
+            latest = versions[-1][1][0]()
+            if latest is registry:
+                return False
+        refs = []
+        for obj in [registry] + _macro_functions(registry):
+            try:
+                refs.append(weakref.ref(obj))
+            except TypeError:  # not weakly referenceable
+                pass
+        if not refs or refs[0]() is not registry:
+            return False
+        number = versions[-1][0] + 1 if versions else 1
+        versions.append((number, refs))
+        self._stamps[fullname] = _source_stamp(mod)
+        return True
+
+    def stamp(self, fullname):
+        """Return the source stamp of the latest recorded version of macro module `fullname`.
+
+        See `imacropy.util._source_stamp`. Return `None` if not available.
+        """
+        return self._stamps.get(fullname)
+
+    def snapshot(self):
+        """Return the current bindings as an immutable value.
+
+        The format is a tuple of ``(fullname, macro_bindings, stamp)``, where
+        `stamp` identifies the version of the module source (see `stamp`).
+        """
+        return tuple((fullname, tuple(tuple(b) for b in macro_bindings), self.stamp(fullname))
+                     for fullname, macro_bindings in self._bindings.items())
+
+    def release(self):
+        """Release superseded macro module versions.
+
+        If any superseded version is still alive, run the garbage collector
+        once, so that versions kept alive only by reference cycles are freed
+        now, not at some arbitrary later time.
+
+        Return the number of superseded versions that are still alive
+        (i.e. referenced from somewhere, typically the user namespace).
+        """
+        self._prune()
+        if not any(self._superseded()):
+            return 0
+        gc.collect()
+        self._prune()
+        return sum(1 for _ in self._superseded())
+
+    def memory_report(self):
+        """Return a human-readable memory report, as a list of lines.
+
+        For each macro module seen by this registry, the report shows the current
+        version number, an estimate of the memory retained by the macro definitions
+        of the current version, and any superseded versions that are still alive,
+        with the number of references keeping them alive.
+        """
+        self.release()
+        if not self._versions:
+            return ["<no macro modules loaded>"]
+        lines = []
+        for fullname, versions in self._versions.items():
+            number, refs = versions[-1]
+            live = [obj for obj in (r() for r in refs) if obj is not None]
+            status = "bound" if fullname in self._bindings else "unbound"
+            size, _ = _retained(live)
+            lines.append(f"{fullname} ({status}): version {number}, {_format_size(size)} retained")
+            for number, refs in versions[:-1]:
+                stale = [obj for obj in (r() for r in refs) if obj is not None]
+                size, internal = _retained(stale)
+                nrefs = _count_referrers(stale, internal)
+                lines.append(f"    superseded version {number} still alive: {_format_size(size)} retained, "
+                             f"{nrefs} stale reference{'s' if nrefs != 1 else ''}")
+        return lines
+
+    def search_report(self, pattern):
+        """Search the macros available in the bound macro modules.
+
+        This covers all macros in those modules, also those not currently imported.
+        See `imacropy.catalog.search` for the pattern syntax.
+
+        Return the results in human-readable form, as a list of lines.
+        """
+        infos = catalog.search(pattern, list(self._bindings))
+        if not infos:
+            return [f"<no macros matching '{pattern}'>"]
+        lines = []
+        for info in infos:
+            asnames = [asname for name, asname in self._bindings[info.module] if name == info.name]
+            imported = f", imported as {', '.join(asnames)}" if asnames else ""
+            summary = f" -- {info.summary}" if info.summary else ""
+            lines.append(f"{info.name} [{info.kind}] from {info.module}{imported}{summary}")
+            if info.span is not None:
+                lines.append(f"    {info.filename}:{info.span[0]}")
+        return lines
+
+    def _superseded(self):
+        """Yield the superseded versions that are still (at least partially) alive."""
+        for versions in self._versions.values():
+            for version in versions[:-1]:
+                if any(r() is not None for r in version[1]):
+                    yield version
+
+    def _prune(self):
+        """Forget superseded versions that have been garbage-collected."""
+        for versions in self._versions.values():
+            versions[:-1] = [v for v in versions[:-1] if any(r() is not None for r in v[1])]
+
+def _macro_functions(registry):
+    """Return the macro functions registered in a `macropy.core.macros.Macros` object."""
+    out = []
+    for macro_registry in getattr(registry, "macro_registries", ()):
+        out.extend(macro_registry.values())
+    return out
+
+def _count_referrers(objs, internal):
+    """Count references to `objs` from outside the object graph they form.
+
+    `internal` is the set of ids of the objects in that graph, as returned by `_retained`.
+    Stack frames are ignored.
+    """
+    return sum(1 for referrer in gc.get_referrers(*objs)
+               if referrer is not objs and id(referrer) not in internal and not isinstance(referrer, FrameType))
+
+def _retained(objs, limit=100000):
+    """Estimate the memory retained by `objs`.
+
+    Return ``(nbytes, ids)``, where `ids` is the set of ids of the objects visited.
+
+    The walk does not enter modules, classes, or module globals, since those
+    are owned by their module, not by the macro definitions that refer to them.
+    At most `limit` objects are visited.
+    """
+    boundary = {id(mod.__dict__) for mod in list(sys.modules.values()) if isinstance(mod, ModuleType)}
+    seen = set()
+    stack = list(objs)
+    total = 0
+    while stack and len(seen) < limit:
+        obj = stack.pop()
+        if id(obj) in seen or id(obj) in boundary or isinstance(obj, (ModuleType, type)):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj, 0)
+        stack.extend(gc.get_referents(obj))
+    return total, seen
+
+def _format_size(nbytes):
+    """Format a size in bytes in human-readable form."""
+    for unit in ("B", "KiB", "MiB"):
+        if nbytes < 1024:
+            return f"{nbytes:.0f} {unit}" if unit == "B" else f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} GiB"
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Cached, searchable catalog of macros.
+
+`inspect.getsourcefile` and `inspect.getsourcelines` re-read and re-tokenize the
+whole defining file on every query. For large macro libraries, that makes browsing
+macro docstrings and source code in the REPL slow. This module instead parses each
+source file once, indexing the line spans of all function and class definitions in it,
+and caches the index until the file's mtime changes.
+
+On top of that, we keep a catalog of the macros in each macro module, with the
+kind of each macro, the first line of its docstring, and its definition site.
+The catalog of a module is rebuilt when the module is reloaded (or when one of
+the files it depends on changes on disk).
+
+This is used by `imacropy.doc`, `imacropy.sourcecode`, and the macro search
+in the REPL consoles (``macros? pattern``, ``%macros pattern``).
+"""
+
+__all__ = ["MacroInfo", "macros_in", "search", "lookup", "source_lines"]
+
+import ast
+import inspect
+import os
+import re
+import sys
+import threading
+import tokenize
+import weakref
+from collections import namedtuple
+
+from . import events
+
+MacroInfo = namedtuple("MacroInfo", ["name", "module", "kind", "summary", "filename", "span"])
+MacroInfo.__doc__ = """Catalog entry for one macro.
+
+`name` is the name the macro is registered under in `module` (a module fullname).
+`kind` is one of ``"expr"``, ``"block"``, ``"decorator"``. `summary` is the first line
+of the docstring (or ``""``). `filename` is the source file of the definition, and
+`span` is ``(firstlineno, lastlineno)`` (1-based, inclusive), or `None` if not available.
+"""
+
+# kind of each registry in `macropy.core.macros.Macros.macro_registries`, in order
+_kinds = ("expr", "block", "decorator")
+
+_lock = threading.Lock()
+_files = {}  # filename -> (mtime, lines, {(name, firstlineno): (firstlineno, lastlineno)})
+_modules = {}  # fullname -> (weakref to macros registry, {filename: mtime}, [MacroInfo, ...])
+
+def macros_in(fullname):
+    """Return a list of `MacroInfo` for all macros in macro module `fullname`.
+
+    The module must be already imported. If it is not, or if it is not a macro
+    module, return an empty list.
+    """
+    mod = sys.modules.get(fullname)
+    registry = getattr(mod, "macros", None)
+    if registry is None or not hasattr(registry, "macro_registries"):
+        return []
+    with _lock:
+        entry = _modules.get(fullname)
+    if entry is not None:
+        ref, mtimes, infos = entry
+        if ref() is registry and all(_mtime(fn) == mt for fn, mt in mtimes.items()):
+            events.record("cache", cache="catalog", hit=True)
+            return infos
+    events.record("cache", cache="catalog", hit=False)
+
+    infos = []
+    mtimes = {}
+    for kind, macro_registry in zip(_kinds, registry.macro_registries):
+        for name, func in sorted(macro_registry.items()):
+            filename, span = _definition_site(func)
+            if filename is not None:
+                mtimes[filename] = _mtime(filename)
+            infos.append(MacroInfo(name, fullname, kind, _summary(func), filename, span))
+    with _lock:
+        _modules[fullname] = (weakref.ref(registry), mtimes, infos)
+    return infos
+
+def search(pattern, fullnames):
+    """Search the catalogs of the macro modules `fullnames`.
+
+    `pattern` is a regular expression (or if invalid as one, a literal string),
+    matched case-insensitively against the macro name, its module name, and the
+    first line of its docstring. An empty pattern matches everything.
+
+    Return a list of matching `MacroInfo`.
+    """
+    try:
+        regex = re.compile(pattern, re.IGNORECASE)
+    except re.error:
+        regex = re.compile(re.escape(pattern), re.IGNORECASE)
+    return [info
+            for fullname in fullnames
+            for info in macros_in(fullname)
+            if regex.search(info.name) or regex.search(info.module) or regex.search(info.summary)]
+
+def lookup(func):
+    """Look up the definition site of a function.
+
+    Return ``(filename, span)`` as in `MacroInfo`, or `None` if not available.
+    """
+    filename, span = _definition_site(func)
+    if span is None:
+        return None
+    return filename, span
+
+def source_lines(filename, span):
+    """Return the source code lines (without line terminators) of `span` in `filename`.
+
+    Return `None` if the file can no longer be read.
+    """
+    index = _file_index(filename)
+    if index is None:
+        return None
+    lines = index[1]
+    first, last = span
+    return [line.rstrip("\r\n") for line in lines[first - 1:last]]
+
+def _summary(func):
+    """Return the first line of the docstring of `func`, or ``""``."""
+    doc = getattr(func, "__doc__", None)
+    if not doc:
+        return ""
+    doc = inspect.cleandoc(doc)
+    return doc.splitlines()[0] if doc else ""
+
+def _definition_site(func):
+    """Return ``(filename, span)`` for `func`. Either may be `None` if not available."""
+    func = inspect.unwrap(func)
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return None, None
+    filename = code.co_filename
+    index = _file_index(filename)
+    if index is None:
+        return None, None
+    defs = index[2]
+    return filename, defs.get((func.__name__, code.co_firstlineno))
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+def _file_index(filename):
+    """Return ``(mtime, lines, defs)`` for source file `filename`, or `None` if not available.
+
+    `defs` maps ``(name, firstlineno)`` of each function and class definition
+    to its span ``(firstlineno, lastlineno)``. Here `firstlineno` is the line of
+    the first decorator, if any, matching `co_firstlineno` of the code object.
+
+    The index is cached, and rebuilt when the mtime of the file changes.
+    """
+    mtime = _mtime(filename)
+    if mtime is None:
+        return None
+    with _lock:
+        index = _files.get(filename)
+    if index is not None and index[0] == mtime:
+        events.record("cache", cache="source", hit=True)
+        return index
+    events.record("cache", cache="source", hit=False)
+
+    try:
+        with tokenize.open(filename) as f:  # respects the encoding declaration, if any
+            source = f.read()
+        tree = ast.parse(source, filename)
+    except (OSError, SyntaxError, ValueError):
+        return None
+    lines = source.splitlines(True)
+    defs = {}
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            first = min([d.lineno for d in node.decorator_list] + [node.lineno])
+            last = getattr(node, "end_lineno", None)  # Python 3.8+
+            if last is None:
+                last = first + len(inspect.getblock(lines[first - 1:])) - 1
+            defs[(node.name, first)] = (first, last)
+    index = (mtime, lines, defs)
+    with _lock:
+        _files[filename] = index
+    return index
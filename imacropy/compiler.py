@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Programmatic macro expansion and compilation, with a code object cache.
+
+This is for embedding macro-enabled Python, e.g. as a rule language in an
+application. Unlike in the REPL consoles, the macro bindings are given explicitly,
+and macro modules are never reloaded automatically; reload them yourself
+(`importlib.reload`) if you want to pick up new macro definitions.
+
+Example::
+
+    from imacropy import expand_and_compile
+
+    bindings = [("unpythonic.syntax", ["let", "letseq"])]
+    code = expand_and_compile("let[((x, 21)) in 2 * x]", bindings, mode="eval")
+    assert eval(code) == 42
+
+The compiled code objects are cached, keyed by the source code, the compile
+options, and the bindings, including the current *version* of each macro module
+(a reload of the module creates a new version). So evaluating the same snippet
+again pays the macro expansion cost only once, and a reload of a macro module
+automatically invalidates the cached code that used its old definitions.
+"""
+
+__all__ = ["CodeCache", "expand_and_compile", "expand_and_compile_many"]
+
+import ast
+import hashlib
+import importlib
+import itertools
+import threading
+import weakref
+from collections import OrderedDict
+from types import CodeType
+
+from macropy.core.macros import ModuleExpansionContext
+
+from . import events
+
+class CodeCache:
+    """Bounded, thread-safe LRU cache of compiled code objects.
+
+    `maxsize` is the maximum number of code objects kept. When the cache is full,
+    the least recently used entry is discarded.
+
+    Attributes `hits` and `misses` count the lookups.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the code object for `key`, or `None` if not cached."""
+        with self._lock:
+            try:
+                code = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                hit = False
+                code = None
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                hit = True
+        events.record("cache", cache="code", hit=hit)
+        return code
+
+    def put(self, key, code):
+        """Store the code object `code` under `key`."""
+        with self._lock:
+            self._entries[key] = code
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Discard all cached code objects, and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+_default_cache = CodeCache()
+
+def expand_and_compile(source, bindings, filename="<macro-input>", mode="exec", flags=0, cache=None):
+    """Macro-expand and compile `source`, returning a code object.
+
+    `bindings` specifies which macros are available, as a list of
+    ``(fullname, macro_bindings)`` pairs, like `macropy.core.macros.detect_macros`
+    returns. `fullname` is the name of a macro module, and `macro_bindings`
+    is a list of ``(name, asname)`` pairs. A bare ``name`` is shorthand for
+    ``(name, name)``. For example::
+
+        [("unpythonic.syntax", ["let", ("letseq", "lets")])]
+
+    is equivalent to ``from unpythonic.syntax import macros, let, letseq as lets``.
+    The macro modules are imported if not already imported, but not reloaded.
+    Macro imports in `source` itself are not processed.
+
+    `filename`, `mode` and `flags` are passed to the builtin `compile`.
+    `mode` may be ``"exec"``, ``"eval"`` or ``"single"``.
+
+    In ``"eval"`` mode, if the macro expansion begins with setup statements (e.g.
+    macros that use ``hq[]`` produce these), the code runs them in a function scope.
+    In that case, `eval` looks up the other names only in the globals it is given.
+
+    `cache` is the `CodeCache` to use; by default, a module-global cache shared
+    by all callers. To disable caching, pass ``cache=False``.
+
+    If a macro name does not exist in its module, raise `ImportError`.
+    If `source` does not compile, raise `SyntaxError` (as `compile` does).
+    """
+    boundmods, bkey = _resolve_bindings(bindings)
+    return _expand_and_compile(source, boundmods, bkey, filename, mode, flags, cache)
+
+def expand_and_compile_many(sources, bindings, filename="<macro-input>", mode="exec", flags=0, cache=None):
+    """Like `expand_and_compile`, but for many snippets that share the same bindings.
+
+    Return a list of code objects, in the same order as `sources`.
+
+    The bindings are resolved only once for the whole batch, and each distinct
+    snippet is macro-expanded only once, also when not found in the cache.
+    """
+    boundmods, bkey = _resolve_bindings(bindings)
+    compiled = {}
+    out = []
+    for source in sources:
+        if source not in compiled:
+            compiled[source] = _expand_and_compile(source, boundmods, bkey, filename, mode, flags, cache)
+        out.append(compiled[source])
+    return out
+
+def _expand_and_compile(source, boundmods, bkey, filename, mode, flags, cache):
+    """Compile one snippet. `boundmods`, `bkey` are as returned by `_resolve_bindings`."""
+    if mode not in ("exec", "eval", "single"):
+        raise ValueError(f"mode must be 'exec', 'eval' or 'single'; got {mode!r}")
+    if cache is None:
+        cache = _default_cache
+    if cache is not False:
+        key = (hashlib.sha256(source.encode("utf-8", "surrogatepass")).digest(), filename, mode, flags, bkey)
+        code = cache.get(key)
+        if code is not None:
+            return code
+
+    tree = ast.parse(source, filename)  # MacroPy expands whole modules, also in "eval" mode.
+    if mode == "eval":
+        _check_expression(tree, "source is not an expression")
+    tree = ModuleExpansionContext(tree, source, boundmods).expand_macros()
+    if mode == "eval":
+        *preamble, last = tree.body
+        if not isinstance(last, ast.Expr):
+            raise SyntaxError("macro expansion did not produce an expression; use mode='exec'")
+        if preamble:
+            code = _compile_with_preamble(preamble, last.value, filename, flags)
+        else:
+            code = compile(ast.Expression(body=last.value), filename, mode, flags, 1)
+    else:
+        if mode == "single":
+            tree = ast.Interactive(tree.body)
+        code = compile(tree, filename, mode, flags, 1)
+
+    if cache is not False:
+        cache.put(key, code)
+    return code
+
+def _compile_with_preamble(preamble, expr, filename, flags):
+    """Compile expression `expr`, preceded by the statements `preamble`, into code `eval` accepts.
+
+    MacroPy's post-processors may prepend setup statements to the macro-expanded module;
+    e.g. ``hq[]`` restores captured values this way. An `ast.Expression` cannot contain
+    statements, so we compile a function that runs the preamble and returns the value of
+    `expr`, and return the code object of that function. `eval` runs it like any other
+    code object. The names bound by the preamble are local to the function; other names
+    are looked up in the globals given to `eval` (not in a separate locals mapping).
+    """
+    module = ast.parse("def _imacropy_eval():\n    pass\n", filename)
+    module.body[0].body = preamble + [ast.copy_location(ast.Return(value=expr), expr)]
+    ast.fix_missing_locations(module)
+    code = compile(module, filename, "exec", flags, 1)
+    return next(const for const in code.co_consts if isinstance(const, CodeType))
+
+def _check_expression(tree, msg):
+    """Raise `SyntaxError` with message `msg` if module `tree` is not a single expression."""
+    if len(tree.body) != 1 or not isinstance(tree.body[0], ast.Expr):
+        raise SyntaxError(msg)
+
+def _resolve_bindings(bindings):
+    """Import and validate the macro modules in `bindings`.
+
+    Return ``(boundmods, key)``, where `boundmods` is in the format
+    `ModuleExpansionContext` expects, and `key` is a hashable value
+    identifying the bindings and the current versions of their modules.
+    """
+    # Boot up MacroPy so ModuleExpansionContext works, and so macro modules that use macros
+    # can be imported. Done lazily, so that just importing `imacropy` has no side effects.
+    import macropy.activate  # noqa: F401
+    boundmods = []
+    key = []
+    for fullname, macro_bindings in bindings:
+        mod = importlib.import_module(fullname)  # usually already imported so just a sys.modules lookup
+        macro_bindings = [(b, b) if isinstance(b, str) else tuple(b) for b in macro_bindings]
+        for origname, _ in macro_bindings:
+            try:
+                getattr(mod, origname)
+            except AttributeError:
+                raise ImportError(f"cannot import name '{origname}' from '{fullname}'")
+        boundmods.append((mod, macro_bindings))
+        key.append((fullname, _version_of(mod), tuple(macro_bindings)))
+    return boundmods, tuple(key)
+
+# Each reload of a macro module creates a new `macros` registry object,
+# so the identity of that object tells the module version apart.
+_versions = weakref.WeakKeyDictionary()
+_versions_lock = threading.Lock()
+_version_counter = itertools.count(1)
+
+def _version_of(mod):
+    """Return a version stamp for macro module `mod`. A reload gets a new stamp."""
+    registry = getattr(mod, "macros", None)
+    if registry is None:
+        raise ImportError(f"module '{mod.__name__}' has no macros")
+    with _versions_lock:
+        try:
+            return _versions[registry]
+        except KeyError:
+            stamp = _versions[registry] = next(_version_counter)
+            return stamp
@@ -11,7 +11,20 @@ This differs from `macropy.core.console.MacroConsole` in that we follow
     ``obj?`` is shorthand for ``doc(obj)``, and ``obj??`` is shorthand
     for ``sourcecode(obj)``.
 
-  - You can use `macros?` to print macros currently imported to the session.
+  - You can use `macros? pattern` to search all macros available in the macro
+    modules imported from (see `imacropy.catalog`), by name, module or docstring.
+
+  - You can use `macros?` to print macros currently imported to the session,
+    and `macros?mem` to print a memory report of the macro modules (current
+    versions, retained sizes, and any superseded versions still kept alive).
+
+  - You can use `macros?events` to print the most recent macro expansion events
+    (see `imacropy.events`).
+
+  - You can use `macros?save filename` to save a snapshot of the session,
+    and `macros?restore filename` to restore it (see `imacropy.snapshot`).
+    `macros?replay filename` restores the session by re-running the saved inputs,
+    instead of restoring the namespace from the saved values.
 
   - Each time a ``from mymodule import macros, ...`` is executed in the REPL,
     the system reloads ``mymodule``, to use the latest macro definitions.
@@ -40,36 +53,54 @@ This differs from `macropy.core.console.MacroConsole` in that we follow
     This does not affect using the macros in the intended way, as macros,
     since macros are expanded away before run-time.
 
+There is also `AsyncMacroConsole`, an asyncio-enabled variant (like ``python -m asyncio``),
+which supports top-level ``await``, with the same `imacropy` semantics.
+
 Based on macropy.core.MacroConsole by Li Haoyi, Justin Holmgren, Alberto Berti
 and all the other contributors, 2013-2019. Used under the MIT license.
 https://github.com/azazel75/macropy
 """
 
-__all__ = ["MacroConsole"]
+__all__ = ["MacroConsole", "AsyncMacroConsole"]
 
 import ast
+import asyncio
+import builtins
 import code
+import concurrent.futures
+import inspect
+import sys
 import textwrap
-import importlib
-from collections import OrderedDict
+import threading
+import traceback
+import types
+import warnings
+from collections import deque
+from time import perf_counter
 
 from macropy.core.macros import ModuleExpansionContext, detect_macros
 from macropy import __version__ as macropy_version
 
+from . import events, snapshot
+from .bindings import MacroBindings
 from .util import _reload_macro_modules
 
 import macropy.activate  # noqa: F401, boot up MacroPy so ModuleExpansionContext works.
 
 
 class MacroConsole(code.InteractiveConsole):
+    history_size = 1000  # how many most recent inputs to keep for session snapshots
+
     def __init__(self, locals=None, filename="<console>"):
         """Parameters like in `code.InteractiveConsole`."""
         super().__init__(locals, filename)
 
         # macro support
-        self._bindings = OrderedDict()
+        self._bindings = MacroBindings()
         self._stubs = set()
         self._stubs_dirty = False
+        self._history = deque(maxlen=self.history_size)  # snapshot.HistoryEntry
+        self._recording = True
 
         # ? and ?? help syntax
         self._internal_execute("import imacropy")
@@ -105,6 +136,58 @@ class MacroConsole(code.InteractiveConsole):
         for asname, fullname in themacros:
             self.write(f"{asname} from {fullname}\n")
 
+    def _search_macros(self, pattern):
+        """Print macros matching `pattern` in the macro modules bound in the session."""
+        for line in self._bindings.search_report(pattern):
+            self.write(f"{line}\n")
+
+    def _report_memory(self):
+        """Print a memory report of the macro modules seen by the session."""
+        for line in self._bindings.memory_report():
+            self.write(f"{line}\n")
+
+    def save_session(self, filename):
+        """Save a snapshot of the session into `filename`. See `imacropy.snapshot`.
+
+        Return a list of the names in the namespace that could not be saved.
+        """
+        return snapshot.save(filename, self.locals, self._bindings, self._history, exclude=self._stubs)
+
+    def restore_session(self, filename, replay=False):
+        """Restore a session snapshot from `filename`. See `imacropy.snapshot`.
+
+        If `replay` is true, re-run the saved inputs instead of restoring
+        the namespace from the saved values.
+
+        Return a list of human-readable lines describing what was done.
+        """
+        snap = snapshot.load(filename)
+        history, messages = snapshot.restore(snap, self.locals, self._bindings, replay=replay,
+                                             flags=self.compile.compiler.flags, runcode=self.runcode,
+                                             refresh=self._force_refresh_stubs)
+        self._history.extend(history)
+        self._force_refresh_stubs()
+        return messages
+
+    def _snapshot_command(self, command, filename):
+        """Handle the ``macros?save``, ``macros?restore`` and ``macros?replay`` commands."""
+        if not filename:
+            self.write(f"Usage: macros?{command} filename\n")
+            return
+        try:
+            if command == "save":
+                skipped = self.save_session(filename)
+                messages = [f"saved session to '{filename}'"]
+                if skipped:
+                    messages.append(f"not saved (cannot be pickled): {', '.join(sorted(skipped))}")
+            else:
+                messages = self.restore_session(filename, replay=(command == "replay"))
+        except (OSError, ValueError) as err:
+            self.write(f"{err.__class__.__name__}: {str(err)}\n")
+            return
+        for line in messages:
+            self.write(f"{line}\n")
+
     def interact(self, banner=None, exitmsg=None):
         """See `code.InteractiveConsole.interact`.
 
@@ -115,6 +198,7 @@ class MacroConsole(code.InteractiveConsole):
         if banner is None:
             self.write("Use obj? to view obj's docstring, and obj?? to view its source code.\n")
             self.write("Use macros? to see macros you have currently imported into the session.\n")
+            self.write("Use macros? pattern to search the macros available in the macro modules you have imported from.\n")
             self.write(f"MacroPy {macropy_version} -- Syntactic macros for Python.\n")
         return super().interact(banner, exitmsg)
 
@@ -123,10 +207,23 @@ class MacroConsole(code.InteractiveConsole):
         if source == "macros?":
             self._list_macros()
             return False  # complete input
+        elif source.startswith("macros? "):
+            self._search_macros(source[len("macros? "):].strip())
+            return False
+        elif source == "macros?mem":
+            self._report_memory()
+            return False
+        elif source == "macros?events":
+            events.dump(file=self)
+            return False
+        elif source.split(" ", 1)[0] in ("macros?save", "macros?restore", "macros?replay"):
+            command, _, filename = source.partition(" ")
+            self._snapshot_command(command[len("macros?"):], filename.strip())
+            return False
         elif source.endswith("??"):
-            return self.runsource(f'imacropy.sourcecode({source[:-2]})')
+            return self._runsource_unrecorded(f'imacropy.sourcecode({source[:-2]})')
         elif source.endswith("?"):
-            return self.runsource(f"imacropy.doc({source[:-1]})")
+            return self._runsource_unrecorded(f"imacropy.doc({source[:-1]})")
 
         try:
             code = self.compile(source, filename, symbol)
@@ -135,12 +232,16 @@ class MacroConsole(code.InteractiveConsole):
         if code is None:  # incomplete input
             return True
 
+        start = perf_counter()
         try:
             tree = ast.parse(source)
             # Must reload modules before detect_macros, because detect_macros reads the macro registry
             # of each module from which macros are imported.
-            _reload_macro_modules(tree, '__main__')
+            reloaded = _reload_macro_modules(tree, '__main__')
+            if self._bindings.note_reload(reloaded):
+                self._stubs_dirty = True  # stubs now point to superseded macro definitions
             # If detect_macros returns normally, it means each fullname (module) can be imported successfully.
+            bindings = []
             try:
                 bindings = detect_macros(tree, '__main__')
             except AttributeError:  # module 'foo' has no attribute 'macros'
@@ -148,38 +249,54 @@ class MacroConsole(code.InteractiveConsole):
             else:
                 if bindings:
                     self._stubs_dirty = True
-                for fullname, macro_bindings in bindings:  # validate before committing
-                    mod = importlib.import_module(fullname)  # already imported so just a sys.modules lookup
-                    for origname, _ in macro_bindings:
-                        try:
-                            getattr(mod, origname)
-                        except AttributeError:
-                            raise ImportError(f"cannot import name '{origname}'")
-                for fullname, macro_bindings in bindings:
-                    mod = importlib.import_module(fullname)
-                    self._bindings[fullname] = (mod, macro_bindings)
+                self._bindings.commit(bindings)
 
+            used = snapshot.used_bindings(tree, self._bindings) if self._recording else None
             tree = ModuleExpansionContext(tree, source, self._bindings.values()).expand_macros()
+            if self._recording:
+                entry = snapshot.make_entry(source, tree, bindings, used, self.compile.compiler.flags)
 
             tree = ast.Interactive(tree.body)
             code = compile(tree, filename, symbol, self.compile.compiler.flags, 1)
-        except (OverflowError, SyntaxError, ValueError):
+        except (OverflowError, SyntaxError, ValueError) as err:
+            events.record("error", error=repr(err))
             self.showsyntaxerror(filename)
             return False  # erroneous input
         except ModuleNotFoundError as err:  # during macro module lookup
             # In this case, the standard stack trace is long and points only to our code and the stdlib,
             # not the erroneous input that's the actual culprit. Better ignore it, and emulate showsyntaxerror.
             # TODO: support sys.excepthook.
+            events.record("error", error=repr(err))
             self.write(f"{err.__class__.__name__}: {str(err)}\n")
             return False  # erroneous input
         except ImportError as err:  # during macro lookup in a successfully imported module
+            events.record("error", error=repr(err))
             self.write(f"{err.__class__.__name__}: {str(err)}\n")
             return False  # erroneous input
+        events.record("input", lines=source.count("\n") + 1, duration=perf_counter() - start)
+        if self._recording:
+            self._history.append(entry)
 
         self.runcode(code)
         self._refresh_stubs()
         return False  # Successfully compiled. `runcode` takes care of any runtime failures.
 
+    def _runsource_unrecorded(self, source):
+        """Like `runsource`, but do not record the input in the session history.
+
+        Used for help lookups, which should not be replayed when restoring a session.
+        """
+        self._recording = False
+        try:
+            return self.runsource(source)
+        finally:
+            self._recording = True
+
+    def _force_refresh_stubs(self):
+        """Refresh macro stub imports, whether or not the bindings have changed."""
+        self._stubs_dirty = True
+        self._refresh_stubs()
+
     def _refresh_stubs(self):
         """Refresh macro stub imports.
 
@@ -213,3 +330,167 @@ class MacroConsole(code.InteractiveConsole):
                 pass
             """
             self._internal_execute(source)
+
+        # Now that the stubs point to the latest definitions, the superseded ones can go.
+        self._bindings.release()
+
+
+class AsyncMacroConsole(MacroConsole):
+    def __init__(self, locals=None, filename="<console>", loop=None):
+        """Asyncio-enabled `MacroConsole`, with top-level ``await``.
+
+        Like ``python -m asyncio``, but with macros. Code is compiled with the
+        top-level ``await`` compiler flag, and run on a persistent event loop.
+        In `interact`, the loop runs in the calling thread, and input is read
+        in a separate thread. So background tasks started in the session keep
+        running also while the console is waiting for input.
+
+        `locals`, `filename`: like in `code.InteractiveConsole`.
+
+        `loop`: the event loop to use. If not given, a new one is created.
+
+        Requires Python 3.8+.
+        """
+        self.loop = loop or asyncio.new_event_loop()
+        self._task = None
+        self._interrupted = False
+        self._interacting = False
+        # `runcode` runs the code as a function, which gets its builtins from its globals.
+        # Like ``python -m asyncio``, make sure they are there.
+        if locals is None:
+            locals = {"__name__": "__console__", "__doc__": None}
+        locals.setdefault("__builtins__", builtins)
+        super().__init__(locals, filename)
+        self.compile.compiler.flags |= ast.PyCF_ALLOW_TOP_LEVEL_AWAIT
+        self._internal_execute("import asyncio")
+
+    def interact(self, banner=None, exitmsg=None):
+        """See `code.InteractiveConsole.interact`.
+
+        Run the event loop in the calling thread (which should be the main thread,
+        so that Ctrl+C works), and the REPL in a new thread. Pressing Ctrl+C
+        cancels the currently running input, if any.
+
+        Return when the REPL exits.
+        """
+        if banner is None:
+            self.write('Use "await" directly instead of "asyncio.run()".\n')
+
+        def repl():
+            try:
+                super(AsyncMacroConsole, self).interact(banner, exitmsg)
+            finally:
+                warnings.filterwarnings("ignore",
+                                        message=r"^coroutine .* was never awaited$",
+                                        category=RuntimeWarning)
+                self.loop.call_soon_threadsafe(self.loop.stop)
+        repl_thread = threading.Thread(target=repl, name="AsyncMacroConsole REPL", daemon=True)
+
+        asyncio.set_event_loop(self.loop)
+        self._interacting = True
+        repl_thread.start()
+        try:
+            while True:
+                try:
+                    self.loop.run_forever()
+                except KeyboardInterrupt:
+                    if self._task is not None and not self._task.done():
+                        self._task.cancel()
+                        self._interrupted = True
+                    continue
+                else:
+                    break
+        finally:
+            self._interacting = False
+
+    def runcode(self, code):
+        """Run a code object in the event loop thread, waiting for it to complete.
+
+        If the code is a coroutine (contains a top-level ``await``), run it as a task.
+
+        When not inside `interact`, run the code in the calling thread,
+        running the event loop until it completes.
+        """
+        if not self._interacting:
+            try:
+                coro = types.FunctionType(code, self.locals)()
+                if inspect.iscoroutine(coro):
+                    self.loop.run_until_complete(coro)
+            except SystemExit:
+                raise
+            except BaseException:
+                self._showtraceback(code)
+            return
+
+        future = concurrent.futures.Future()
+
+        def callback():
+            self._task = None
+            self._interrupted = False
+
+            func = types.FunctionType(code, self.locals)
+            try:
+                coro = func()
+            except SystemExit:
+                raise
+            except KeyboardInterrupt as err:
+                self._interrupted = True
+                future.set_exception(err)
+                return
+            except BaseException as err:
+                future.set_exception(err)
+                return
+
+            if not inspect.iscoroutine(coro):
+                future.set_result(coro)
+                return
+
+            try:
+                self._task = self.loop.create_task(coro)
+                self._task.add_done_callback(_copy_outcome(future))
+            except BaseException as err:
+                future.set_exception(err)
+
+        self.loop.call_soon_threadsafe(callback)
+
+        try:
+            return future.result()
+        except SystemExit:
+            raise
+        except BaseException:
+            if self._interrupted:
+                self.write("\nKeyboardInterrupt\n")
+            else:
+                self._showtraceback(code)
+
+    def _showtraceback(self, code):
+        """Like `showtraceback`, but omit the frames of the event loop machinery.
+
+        The traceback is shown starting from the frame running `code`, like in `MacroConsole`.
+        """
+        exctype, value, tb = sys.exc_info()
+        frame = tb
+        while frame is not None and frame.tb_frame.f_code is not code:
+            frame = frame.tb_next
+        if frame is None:  # failed before running the input
+            self.showtraceback()
+            return
+        sys.last_type, sys.last_value, sys.last_traceback = exctype, value, frame
+        if sys.excepthook is sys.__excepthook__:
+            self.write("".join(traceback.format_exception(exctype, value, frame)))
+        else:  # see code.InteractiveInterpreter.showtraceback
+            sys.excepthook(exctype, value, frame)
+
+def _copy_outcome(future):
+    """Return a done callback for an asyncio task, that copies its outcome into `future`.
+
+    `future` is a `concurrent.futures.Future`, so another thread can wait on it.
+    """
+    def callback(task):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+    return callback
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Always-on ring buffer of macro expansion events.
+
+Enabling `macropy.logging` (``macropy3 -d``) is too verbose and too slow to leave on
+all the time. This module instead keeps the most recent structured events in a
+fixed-size in-memory buffer, which costs about a microsecond per event, so it can
+stay enabled. When something goes wrong, dump the buffer to see what happened
+just before.
+
+The REPL consoles and the bootstrapper record these kinds of events:
+
+  - ``reload``: a macro module was reloaded (`module`, `duration`).
+  - ``preload``: a macro module was preloaded in the background (`module`, `duration`).
+  - ``bind``: macros were bound from a module (`module`, `names`).
+  - ``input``: a REPL input was macro-expanded and compiled (`lines`, `duration`).
+  - ``expand``: MacroPy expanded macros in a module, e.g. at import time (`lines`, `duration`).
+    Recorded only if `install_expansion_hooks` has been called.
+  - ``error``: macro expansion of an input, or preloading a macro module, failed (`error`).
+  - ``cache``: a cache lookup (`cache`, `hit`).
+  - ``snapshot``: a REPL session snapshot was saved (`path`, `inputs`, `names`).
+    See `imacropy.snapshot`.
+  - ``restore``: a REPL session snapshot was restored (`inputs`, `reexpanded`, `rerun`, `reloaded`).
+  - ``bootstrap``: the bootstrapper is about to import the main program (`target`).
+
+Durations are in seconds.
+
+To view the buffer, use `dump`, or in the REPL, ``macros?events`` (`MacroConsole`)
+or ``%macros --events`` (IPython extension). To dump it automatically when the
+program dies from an uncaught exception, call `dump_on_exception`
+(the bootstrapper does this with ``macropy3 -e``).
+"""
+
+__all__ = ["Event", "record", "events", "dump", "clear", "resize",
+           "enable", "disable", "dump_on_exception", "install_expansion_hooks"]
+
+import sys
+import time
+from collections import deque, namedtuple
+
+Event = namedtuple("Event", ["time", "kind", "data"])
+Event.__doc__ = """A recorded event. `time` is as returned by `time.time`, `data` is a dict."""
+
+_buffer = deque(maxlen=1000)
+_enabled = True
+
+def record(kind, **data):
+    """Record an event of the given kind, with the given data, into the buffer.
+
+    When the buffer is full, the oldest event is discarded.
+    """
+    if _enabled:
+        _buffer.append(Event(time.time(), kind, data))
+
+def events(kind=None):
+    """Return a list of the events currently in the buffer, oldest first.
+
+    If `kind` is given, return only events of that kind.
+    """
+    if kind is None:
+        return list(_buffer)
+    return [e for e in list(_buffer) if e.kind == kind]
+
+def dump(file=None, kind=None):
+    """Print the events currently in the buffer, oldest first, one per line.
+
+    `file` defaults to `sys.stdout`. If `kind` is given, print only events of that kind.
+    """
+    if file is None:
+        file = sys.stdout
+    theevents = events(kind)
+    if not theevents:
+        print("<no events recorded>", file=file)
+        return
+    for e in theevents:
+        print(_format_event(e), file=file)
+
+def clear():
+    """Discard all events currently in the buffer."""
+    _buffer.clear()
+
+def resize(maxlen):
+    """Set the buffer size (number of events kept). Keep the most recent events."""
+    global _buffer
+    _buffer = deque(_buffer, maxlen=maxlen)
+
+def enable():
+    """Enable recording of events (the default)."""
+    global _enabled
+    _enabled = True
+
+def disable():
+    """Disable recording of events. The events already in the buffer are kept."""
+    global _enabled
+    _enabled = False
+
+def dump_on_exception(file=None):
+    """Install a `sys.excepthook` that dumps the event buffer on an uncaught exception.
+
+    The previous hook runs first, so the traceback is printed before the events.
+    `file` defaults to `sys.stderr`.
+    """
+    previous_hook = sys.excepthook
+    def excepthook(exctype, value, traceback):
+        previous_hook(exctype, value, traceback)
+        out = file if file is not None else sys.stderr
+        print("Most recent macro expansion events:", file=out)
+        dump(file=out)
+    sys.excepthook = excepthook
+
+_hooks_installed = False
+def install_expansion_hooks():
+    """Record an ``expand`` event for each module MacroPy macro-expands.
+
+    This hooks into `macropy.core.macros.ModuleExpansionContext`, so it covers also
+    modules macro-expanded at import time by MacroPy's import hooks. Installing
+    the hooks more than once has no further effect.
+    """
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    from macropy.core.macros import injected_vars, post_processing
+    injected_vars.append(_imacropy_expand_start)
+    post_processing.append(_imacropy_expand_done)
+    _hooks_installed = True
+
+# MacroPy makes the return value of each injected var available to post-processors
+# under the name of the function.
+def _imacropy_expand_start(**kw):
+    return time.perf_counter()
+
+def _imacropy_expand_done(tree, src, _imacropy_expand_start, **kw):
+    record("expand", lines=src.count("\n") + 1, duration=time.perf_counter() - _imacropy_expand_start)
+    return tree
+
+def _format_event(e):
+    """Format an event as a human-readable line."""
+    timestamp = time.strftime("%H:%M:%S", time.localtime(e.time)) + f".{int(e.time % 1 * 1e6):06d}"
+    fields = []
+    for k, v in e.data.items():
+        if k == "duration":
+            fields.append(f"{k}={v * 1e3:.3f}ms")
+        else:
+            fields.append(f"{k}={v!r}")
+    return " ".join([timestamp, e.kind] + fields)
@@ -11,10 +11,35 @@ To autoload it at IPython startup, put this into your ``ipython_config.py``::
 
 To find your config file, ``ipython profile locate``.
 
+To import some macro modules in a background thread as soon as the extension loads,
+so that the first ``from mymodule import macros, ...`` in the session finds them
+ready, put this into your ``ipython_config.py``::
+
+    c.IMacroPyExtension.preload = ["unpythonic.syntax"]
+
+If preloading is still running when a cell imports macros, that cell waits for it
+to finish. Errors during preloading are not printed (so as not to disturb tools
+that read IPython's startup output); they are recorded in `imacropy.events`.
+
 Notes:
 
   - You can use the line magic `%macros` to print macros currently imported
-    to the session.
+    to the session, and `%macros --memory` to print a memory report of the
+    macro modules (current versions, retained sizes, and any superseded
+    versions still kept alive).
+
+  - You can use `%macros pattern` to search all macros available in the macro
+    modules imported from (see `imacropy.catalog`), by name, module or docstring.
+
+  - You can use `%macros --events` to print the most recent macro expansion
+    events (see `imacropy.events`).
+
+  - You can use `%macros --save filename` to save a snapshot of the session,
+    and `%macros --restore filename` to restore it (see `imacropy.snapshot`).
+    `%macros --replay filename` restores the session by re-running the saved
+    inputs, instead of restoring the namespace from the saved values.
+    The history keeps the most recent ``c.IMacroPyExtension.history_size``
+    inputs (default 1000).
 
   - Each time a ``from mymodule import macros, ...`` is executed in the REPL,
     the system reloads ``mymodule``, to use the latest macro definitions.
@@ -42,19 +67,27 @@ Notes:
 """
 
 import ast
-import importlib
-from collections import OrderedDict
+import re
+import threading
+from collections import deque
 from functools import partial
+from time import perf_counter
 
 from IPython.core.error import InputRejected
 from IPython.core.magic import register_cell_magic, register_line_magic
+from traitlets import Int, List, Unicode
+from traitlets.config import Configurable
 
 from macropy import __version__ as macropy_version
 from macropy.core.macros import ModuleExpansionContext, detect_macros
 
-from .util import _reload_macro_modules
+from . import events, snapshot
+from .bindings import MacroBindings
+from .util import _macro_imports, _preload_macro_modules, _reload_macro_modules
 
 _placeholder = "<interactive input>"
+_session_magics = ("macros", "pinfo", "pinfo2", "psearch")  # see _is_session_command
+_ipython_cache_name = re.compile(r"^_(_*|\d+|i+\d*|oh|ih|dh)$")  # _, __, _5, _i, _ii, _i5, _oh, ...
 _instance = None
 
 def load_ipython_extension(ipython):
@@ -79,11 +112,16 @@ class MacroTransformer(ast.NodeTransformer):
     def __init__(self, extension_instance, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.ext = extension_instance
-        self.bindings = OrderedDict()
+        self.bindings = MacroBindings()
 
     def visit(self, tree):
+        start = perf_counter()
         try:
-            _reload_macro_modules(tree, '__main__')
+            self.ext.wait_for_preload(tree)
+            reloaded = _reload_macro_modules(tree, '__main__')
+            if self.bindings.note_reload(reloaded):
+                self.ext.macro_bindings_changed = True  # stubs now point to superseded macro definitions
+            bindings = []
             try:
                 bindings = detect_macros(tree, '__main__')  # macro imports
             except AttributeError:  # module 'foo' has no attribute 'macros'
@@ -91,23 +129,42 @@ class MacroTransformer(ast.NodeTransformer):
             else:
                 if bindings:
                     self.ext.macro_bindings_changed = True
-                    for fullname, macro_bindings in bindings:  # validate before committing
-                        mod = importlib.import_module(fullname)  # already imported so just a sys.modules lookup
-                        for origname, _ in macro_bindings:
-                            try:
-                                getattr(mod, origname)
-                            except AttributeError:
-                                raise ImportError(f"cannot import name '{origname}'")
-                    for fullname, macro_bindings in bindings:
-                        mod = importlib.import_module(fullname)
-                        self.bindings[fullname] = (mod, macro_bindings)
+                    self.bindings.commit(bindings)
+            # Record only the cell itself, not code that magics such as %time macro-expand while it runs.
+            record = self.ext.cell_pending and not self.ext.internal and not _is_session_command(tree)
+            self.ext.cell_pending = False
+            used = snapshot.used_bindings(tree, self.bindings) if record else None
             newtree = ModuleExpansionContext(tree, self.ext.src, self.bindings.values()).expand_macros()
+            src = self.ext.src  # list of lines in IPython 7.0+, a string before that
+            if not self.ext.internal:
+                nlines = len(src) if isinstance(src, list) else src.count("\n") + 1
+                events.record("input", lines=nlines, duration=perf_counter() - start)
+            if record:
+                source = "".join(src) if isinstance(src, list) else src
+                self.ext.history.append(snapshot.make_entry(source, newtree, bindings, used,
+                                                            self.ext.shell.compile.flags))
             self.ext.src = _placeholder
             return newtree
         except Exception as err:
+            events.record("error", error=repr(err))
             # see IPython.core.interactiveshell.InteractiveShell.transform_ast()
             raise InputRejected(*err.args)
 
+def _is_session_command(tree):
+    """Return whether `tree` is a ``%macros`` command or a help lookup (``obj?``, ``obj??``).
+
+    These are not recorded in the session history, so that replaying a session
+    does not re-run them.
+    """
+    if len(tree.body) != 1 or not isinstance(tree.body[0], ast.Expr):
+        return False
+    call = tree.body[0].value  # get_ipython().run_line_magic('macros', '--save foo')
+    if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and
+            call.func.attr == "run_line_magic" and call.args):
+        return False
+    magic = call.args[0]
+    return getattr(magic, "value", getattr(magic, "s", None)) in _session_magics
+
 # avoid complaining about typoed macro names...
 @register_cell_magic
 def ignore_importerror(line, cell):  # ...when their stubs are loaded
@@ -125,8 +182,32 @@ def ignore_nameerror(line, cell):  # ...when they are unloaded
 
 @register_line_magic
 def macros(line):
-    """Print a human-readable list of macros currently imported into the session."""
+    """Print a human-readable list of macros currently imported into the session.
+
+    With a pattern, search all macros available in the macro modules
+    imported from, instead.
+
+    With ``--memory``, print a memory report of the macro modules instead.
+    With ``--events``, print the most recent macro expansion events.
+    With ``--save filename``, ``--restore filename`` or ``--replay filename``,
+    save or restore a snapshot of the session.
+    """
     t = _instance.macro_transformer
+    command, _, filename = line.strip().partition(" ")
+    if command in ("--save", "--restore", "--replay"):
+        _instance.snapshot_command(command[2:], filename.strip())
+        return
+    if line.strip() == "--memory":
+        for reportline in t.bindings.memory_report():
+            print(reportline)
+        return
+    if line.strip() == "--events":
+        events.dump()
+        return
+    if line.strip():
+        for reportline in t.bindings.search_report(line.strip()):
+            print(reportline)
+        return
     if not t.bindings:
         print("<no macros imported>")
         return
@@ -139,8 +220,19 @@ def macros(line):
         print(f"{asname} from {fullname}")
 
 
-class IMacroPyExtension:
+class IMacroPyExtension(Configurable):
+    preload = List(Unicode(),
+                   help="""Macro modules to import in a background thread when the extension loads.
+
+                   The first macro import from these modules in the session then does not
+                   need to wait for the import (nor reload them, unless they have changed
+                   on disk in the meantime).""").tag(config=True)
+    history_size = Int(1000,
+                       help="""How many most recent inputs to keep in the history for session snapshots
+                       (``%macros --save``).""").tag(config=True)
+
     def __init__(self, shell):
+        super().__init__(parent=shell)
         self.src = _placeholder
         self.shell = shell
         ipy = self.shell.get_ipython()
@@ -153,16 +245,41 @@ class IMacroPyExtension:
 
         self.macro_bindings_changed = False
         self.current_stubs = set()
+        self.history = deque(maxlen=self.history_size)  # snapshot.HistoryEntry
+        self.internal = False  # True while running internal support code, which is not recorded in the history
+        self.cell_pending = False  # True until the current cell has been macro-expanded
+        self.preload_errors = []
+        self.preloader = None
         self.macro_transformer = MacroTransformer(extension_instance=self)
         self.shell.ast_transformers.append(self.macro_transformer)  # TODO: last or first?
 
+        ipy.events.register('pre_run_cell', self._begin_cell)
         ipy.events.register('post_run_cell', self._refresh_stubs)
 
         # initialize MacroPy in the session
+        self.internal = True
         self.shell.run_cell("import macropy.activate", store_history=False, silent=True)
+        self.internal = False
+
+        # MacroPy must be active first, so that macro modules that use macros can be imported.
+        if self.preload:
+            self.preloader = threading.Thread(target=self._preload, name="imacropy preload", daemon=True)
+            self.preloader.start()
+
+    def _preload(self):
+        """Import the configured macro modules. Runs in a background thread."""
+        self.preload_errors = _preload_macro_modules(list(self.preload))
+
+    def wait_for_preload(self, tree):
+        """If `tree` imports macros, wait until preloading (if any) has finished."""
+        preloader = self.preloader
+        if preloader is not None and _macro_imports(tree):
+            preloader.join()
+            self.preloader = None
 
     def __del__(self):
         ipy = self.shell.get_ipython()
+        ipy.events.unregister('pre_run_cell', self._begin_cell)
         ipy.events.unregister('post_run_cell', self._refresh_stubs)
         self.shell.ast_transformers.remove(self.macro_transformer)
         if self.new_api:
@@ -170,6 +287,62 @@ class IMacroPyExtension:
         else:
             ipy.events.unregister('pre_run_cell', self._get_source_code_legacy)
 
+    def save_session(self, filename):
+        """Save a snapshot of the session into `filename`. See `imacropy.snapshot`.
+
+        Return a list of the names in the namespace that could not be saved.
+        """
+        exclude = set(self.shell.user_ns_hidden) | self.current_stubs
+        exclude.update(name for name in self.shell.user_ns if _ipython_cache_name.match(name))
+        return snapshot.save(filename, self.shell.user_ns, self.macro_transformer.bindings, self.history,
+                             exclude=exclude)
+
+    def restore_session(self, filename, replay=False):
+        """Restore a session snapshot from `filename`. See `imacropy.snapshot`.
+
+        If `replay` is true, re-run the saved inputs instead of restoring
+        the namespace from the saved values.
+
+        Return a list of human-readable lines describing what was done.
+        """
+        snap = snapshot.load(filename)
+        history, messages = snapshot.restore(snap, self.shell.user_ns, self.macro_transformer.bindings,
+                                             replay=replay, flags=self.shell.compile.flags, runcode=self._runcode,
+                                             refresh=self._force_refresh_stubs)
+        self.history.extend(history)
+        self._force_refresh_stubs()
+        return messages
+
+    def snapshot_command(self, command, filename):
+        """Handle ``%macros --save``, ``--restore`` and ``--replay``."""
+        if not filename:
+            print(f"Usage: %macros --{command} filename")
+            return
+        try:
+            if command == "save":
+                skipped = self.save_session(filename)
+                messages = [f"saved session to '{filename}'"]
+                if skipped:
+                    messages.append(f"not saved (cannot be pickled): {', '.join(sorted(skipped))}")
+            else:
+                messages = self.restore_session(filename, replay=(command == "replay"))
+        except (OSError, ValueError) as err:
+            print(f"{err.__class__.__name__}: {str(err)}")
+            return
+        for line in messages:
+            print(line)
+
+    def _runcode(self, code):
+        """Run a restored code object in the user namespace, reporting any exception."""
+        try:
+            exec(code, self.shell.user_ns)
+        except Exception:
+            self.shell.showtraceback()
+
+    def _begin_cell(self, info):
+        """Note that a new cell is about to run. (Internal silent cells do not trigger this.)"""
+        self.cell_pending = True
+
     def _get_source_code_legacy(self, info):
         """Get the source code of the current cell just before it runs.
 
@@ -186,6 +359,11 @@ class IMacroPyExtension:
         self.src = lines
         return lines
 
+    def _force_refresh_stubs(self):
+        """Refresh macro stub imports, whether or not the bindings have changed."""
+        self.macro_bindings_changed = True
+        self._refresh_stubs(None)
+
     def _refresh_stubs(self, info):
         """Refresh macro stub imports.
 
@@ -197,9 +375,15 @@ class IMacroPyExtension:
         if not self.macro_bindings_changed:
             return
         self.macro_bindings_changed = False
-        internal_execute = partial(self.shell.run_cell,
-                                   store_history=False,
-                                   silent=True)
+        run_cell = partial(self.shell.run_cell,
+                           store_history=False,
+                           silent=True)
+        def internal_execute(source):
+            self.internal = True
+            try:
+                run_cell(source)
+            finally:
+                self.internal = False
 
         # Clear previous stubs, because our MacroTransformer overrides
         # the available set of macros from a given module with those
@@ -215,3 +399,6 @@ class IMacroPyExtension:
             stubnames = ", ".join("{} as {}".format(name, asname) for name, asname in macro_bindings)
             internal_execute("%%ignore_importerror\n"
                              "from {} import {}".format(fullname, stubnames))
+
+        # Now that the stubs point to the latest definitions, the superseded ones can go.
+        self.macro_transformer.bindings.release()
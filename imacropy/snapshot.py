@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""Save and restore macro-enabled REPL sessions.
+
+Restarting a REPL session normally means replaying every macro import, reload
+and macro expansion before being back to a working state. A snapshot instead
+persists, into a compact local file:
+
+  - the macro bindings of the session, with a version stamp (a hash of the source
+    file) of each macro module,
+  - the input history, with the macro-expanded, compiled code of each input, the
+    macro imports it performed, and the bindings (with version stamps) of those
+    macro modules whose macros it uses,
+  - the picklable parts of the user namespace. Modules are saved by name and
+    re-imported. The names of the values that cannot be pickled (e.g. functions
+    and classes defined in the session, and instances of those classes) are
+    recorded, but their values are not saved.
+
+When a snapshot is restored, only those macro modules whose source has changed
+are reloaded.
+
+The namespace can be restored either from the saved values (the default), or by
+replaying the input history (for sessions whose state is not picklable). When
+restoring from the saved values, the inputs that define any of the values that
+could not be saved are run again (and the saved values are then restored on top,
+so that those inputs do not overwrite them). Note this re-runs any side effects
+of those inputs.
+
+The saved code of an input is reused if none of the macro modules whose macros
+it uses has changed. Inputs that need to be run, but whose macro modules have
+changed, are macro-expanded again.
+
+The consoles keep only the most recent inputs in the history (by default, 1000),
+so that a long session does not accumulate them without bound. Replaying a
+session whose history has been truncated re-runs only the inputs that were kept.
+
+**CAUTION**: Restoring a snapshot unpickles and runs code from the file.
+Only restore snapshots you created yourself.
+
+This is used by `MacroConsole` (``macros?save``, ``macros?restore``, ``macros?replay``)
+and the IPython extension (``%macros --save``, ``--restore``, ``--replay``).
+"""
+
+__all__ = ["HistoryEntry", "used_bindings", "make_entry", "save", "load", "restore"]
+
+import ast
+import importlib
+import importlib.util
+import marshal
+import os
+import pickle
+import sys
+import zlib
+from collections import namedtuple
+from types import ModuleType
+
+from macropy.core.macros import Macros, ModuleExpansionContext, detect_macros
+
+from . import events
+from .util import _source_stamp
+
+HistoryEntry = namedtuple("HistoryEntry", ["source", "code", "imports", "bindings"])
+HistoryEntry.__doc__ = """One input in the history of a REPL session.
+
+`source` is the source code as typed. `code` is the macro-expanded code, compiled
+in ``"exec"`` mode, or `None` if that was not possible. `imports` are the macro
+imports the input performed, as returned by `detect_macros` (but as tuples).
+`bindings` is the part of `MacroBindings.snapshot` for the macro modules whose
+macros the input uses, when the input was macro-expanded (see `used_bindings`).
+"""
+
+_header = b"imacropy-snapshot 1\n"
+_filename = "<input>"
+
+def used_bindings(tree, bindings):
+    """Return the part of ``bindings.snapshot()`` that `tree` uses.
+
+    `tree` is the AST of an input, before macro expansion, and `bindings` the
+    `MacroBindings` of the session. A macro module is considered used if the
+    input refers to any of the macros bound from it by name.
+    """
+    names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+    return tuple((fullname, macro_bindings, stamp)
+                 for fullname, macro_bindings, stamp in bindings.snapshot()
+                 if any(asname in names for _, asname in macro_bindings))
+
+def make_entry(source, expanded, imports, used, flags=0):
+    """Make a `HistoryEntry` for an input.
+
+    `expanded` is the macro-expanded AST (an `ast.Module`), which is compiled
+    in ``"exec"`` mode with compiler flags `flags`. `imports` is the return value
+    of `detect_macros` for the input, and `used` that of `used_bindings`.
+    """
+    try:
+        code = compile(expanded, _filename, "exec", flags, 1)
+    except (SyntaxError, ValueError, TypeError):
+        code = None  # e.g. top-level await without the flag; macro-expanded again when restored
+    imports = tuple((fullname, tuple(tuple(b) for b in macro_bindings)) for fullname, macro_bindings in imports)
+    return HistoryEntry(source, code, imports, used)
+
+def save(path, namespace, bindings, history, exclude=()):
+    """Save a REPL session snapshot into the file `path`.
+
+    `namespace` is the user namespace (a dict), `bindings` the `MacroBindings`
+    of the session, and `history` a sequence of `HistoryEntry`. Names in `exclude`,
+    names starting with two underscores, and macro registries (the `macros`
+    objects bound by macro imports) are not saved from the namespace.
+
+    Return a list of the names that were skipped because their values could not be pickled.
+    """
+    modules = {}
+    values = {}
+    skipped = []
+    for name, value in list(namespace.items()):
+        if name.startswith("__") or name in exclude:
+            continue
+        if isinstance(value, Macros):  # bound by a macro import, not user data
+            continue
+        if isinstance(value, ModuleType):
+            modules[name] = value.__name__
+            continue
+        try:
+            values[name] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            skipped.append(name)
+
+    entries = [(entry.source, _marshal(entry.code), entry.imports, entry.bindings) for entry in history]
+    data = {"magic": importlib.util.MAGIC_NUMBER,
+            "bindings": bindings.snapshot(),
+            "history": entries,
+            "modules": modules,
+            "namespace": values,
+            "unsaved": skipped}
+    payload = _header + zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+    tmppath = f"{path}.tmp"
+    with open(tmppath, "wb") as f:
+        f.write(payload)
+    os.replace(tmppath, path)  # don't leave a truncated snapshot if we crash halfway
+    events.record("snapshot", path=path, inputs=len(entries), names=len(values) + len(modules))
+    return skipped
+
+def load(path):
+    """Load a REPL session snapshot from the file `path`. Return it as a dict.
+
+    Raise `ValueError` if the file is not a snapshot.
+    """
+    with open(path, "rb") as f:
+        payload = f.read()
+    if not payload.startswith(_header):
+        raise ValueError(f"'{path}' is not an imacropy session snapshot")
+    return pickle.loads(zlib.decompress(payload[len(_header):]))
+
+def restore(snap, namespace, bindings, replay=False, flags=0, runcode=None, refresh=None):
+    """Restore a REPL session snapshot `snap`, as returned by `load`.
+
+    `namespace` is the user namespace (a dict) and `bindings` the `MacroBindings`
+    of the session to restore into. `flags` are the compiler flags for inputs that
+    need to be macro-expanded again.
+
+    First, the macro modules are brought up to date (reloading only those whose
+    source has changed). Then the input history is restored, reusing the saved
+    code where possible.
+
+    Code is run by calling ``runcode(code)``. After the macro bindings change,
+    ``refresh()`` is called (if given), so that the consoles can update their
+    macro stubs.
+
+    If `replay` is false, the saved bindings are committed into `bindings`, and
+    the namespace is restored from the saved values. The inputs that bind any of
+    the names whose values could not be saved are run again, in order, and then
+    the saved values are restored once more, on top.
+
+    If `replay` is true, all inputs are instead run again, in order. The macro
+    imports of each input are committed into `bindings` before running it.
+    Finally, the saved bindings are committed, like when not replaying.
+
+    An input is macro-expanded again only if it needs to be run, and its saved
+    code cannot be reused (a macro module it uses has changed, or the snapshot
+    was saved by a different Python version).
+
+    Return ``(history, messages)``, where `history` is the restored list of
+    `HistoryEntry`, and `messages` is a list of human-readable lines describing
+    what was done, including any problems.
+    """
+    messages = []
+    stamps = {}  # fullname -> current stamp
+
+    # Macro modules used by the bindings, or by any input in the history.
+    wanted = {}
+    for entry_bindings in [snap["bindings"]] + [b for _, _, _, b in snap["history"]]:
+        for fullname, _, stamp in entry_bindings:
+            wanted.setdefault(fullname, stamp)
+    for _, _, imports, _ in snap["history"]:
+        for fullname, _ in imports:
+            wanted.setdefault(fullname, None)
+    reloaded = []
+    for fullname, saved_stamp in wanted.items():
+        try:
+            mod = sys.modules.get(fullname)
+            if mod is None:  # first import, already the latest version
+                mod = importlib.import_module(fullname)
+            else:
+                loaded_stamp = bindings.stamp(fullname) if fullname in bindings else saved_stamp
+                if loaded_stamp is not None and _source_stamp(mod) != loaded_stamp:
+                    mod = importlib.reload(mod)
+                    reloaded.append(fullname)
+        except Exception as err:
+            messages.append(f"cannot load macro module '{fullname}': {err.__class__.__name__}: {err}")
+            continue
+        stamps[fullname] = _source_stamp(mod)
+    bindings.note_reload(reloaded)
+    if reloaded:
+        messages.append(f"reloaded changed macro modules: {', '.join(reloaded)}")
+
+    unsaved = set(snap["unsaved"])
+    history = []
+    torun = []  # entries to run, in order
+    nreexpanded = 0
+    samepython = snap["magic"] == importlib.util.MAGIC_NUMBER
+    for source, codebytes, imports, entry_bindings in snap["history"]:
+        needed = replay or bool(_bound_names(source) & unsaved)
+        unchanged = all(fullname in stamps and stamps[fullname] == stamp
+                        for fullname, _, stamp in entry_bindings)
+        code = None
+        if codebytes is not None and samepython and unchanged:
+            code = marshal.loads(codebytes)
+        elif needed:
+            try:
+                code = _reexpand(source, entry_bindings, flags)
+            except Exception as err:
+                messages.append(f"skipping input that no longer expands: {source!r}: {err.__class__.__name__}: {err}")
+                continue
+            entry_bindings = tuple((fullname, macro_bindings, stamps.get(fullname))
+                                   for fullname, macro_bindings, _ in entry_bindings)
+            nreexpanded += 1
+        # An entry not needed now, whose saved code cannot be reused, keeps its old stamps
+        # and no code, so it is macro-expanded again when it is needed.
+        entry = HistoryEntry(source, code, imports, entry_bindings)
+        history.append(entry)
+        if needed:
+            torun.append(entry)
+    messages.append(f"restored {len(history)} inputs ({nreexpanded} macro-expanded again)")
+    events.record("restore", inputs=len(history), reexpanded=nreexpanded, rerun=len(torun), reloaded=reloaded)
+
+    if replay:
+        for entry in torun:
+            if entry.imports:
+                _commit(bindings, entry.imports, stamps, messages)
+                if refresh is not None:
+                    refresh()
+            runcode(entry.code)
+        _commit(bindings, snap["bindings"], stamps, messages)
+        return history, messages
+
+    _commit(bindings, snap["bindings"], stamps, messages)
+    if refresh is not None:
+        refresh()  # the inputs we run may refer to macro stubs
+    failed = _restore_values(snap, namespace)
+    if torun:
+        for entry in torun:
+            runcode(entry.code)
+        _restore_values(snap, namespace)
+        messages.append(f"ran again {len(torun)} inputs, to restore values that could not be saved")
+    nrestored = len(snap["modules"]) + len(snap["namespace"]) - len(failed)
+    nrestored += sum(1 for name in unsaved if name in namespace)
+    failed.extend(name for name in unsaved if name not in namespace)
+    messages.append(f"restored {nrestored} names")
+    if failed:
+        messages.append(f"could not restore: {', '.join(sorted(failed))}")
+    return history, messages
+
+def _restore_values(snap, namespace):
+    """Restore the saved modules and values of snapshot `snap` into `namespace`.
+
+    Return a list of the names that could not be restored.
+    """
+    failed = []
+    for name, modname in snap["modules"].items():
+        try:
+            namespace[name] = importlib.import_module(modname)
+        except Exception:
+            failed.append(name)
+    for name, data in snap["namespace"].items():
+        try:
+            namespace[name] = pickle.loads(data)
+        except Exception:
+            failed.append(name)
+    return failed
+
+def _bound_names(source):
+    """Return the set of names that top-level code in `source` binds.
+
+    This does not look inside function and class bodies, lambdas, or comprehensions.
+    """
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return set()
+    names = set()
+    stack = list(tree.body)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+            stack.extend(node.decorator_list)
+            continue
+        if isinstance(node, (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+            continue
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update((alias.asname or alias.name).split(".")[0] for alias in node.names)
+            continue
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+        stack.extend(ast.iter_child_nodes(node))
+    return names
+
+def _commit(bindings, saved, stamps, messages):
+    """Commit `saved` bindings (in snapshot or `detect_macros` format) of the loaded macro modules."""
+    for fullname, macro_bindings, *_ in saved:
+        if fullname not in stamps:  # could not be loaded
+            continue
+        try:
+            bindings.commit([(fullname, [tuple(b) for b in macro_bindings])])
+        except ImportError as err:
+            messages.append(f"cannot bind macros from '{fullname}': {err}")
+
+def _marshal(code):
+    """Serialize the compiled code of a history entry, if any."""
+    if code is None:
+        return None
+    return marshal.dumps(code)
+
+def _reexpand(source, entry_bindings, flags):
+    """Macro-expand and compile `source` again, with the given bindings."""
+    tree = ast.parse(source)
+    try:
+        detect_macros(tree, '__main__')  # strip macro names from macro imports
+    except AttributeError:  # module 'foo' has no attribute 'macros'
+        pass
+    boundmods = [(sys.modules[fullname], [tuple(b) for b in macro_bindings])
+                 for fullname, macro_bindings, _ in entry_bindings]
+    tree = ModuleExpansionContext(tree, source, boundmods).expand_macros()
+    return compile(tree, _filename, "exec", flags, 1)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""A macro using hygienic quasiquotes, for testing.
+
+MacroPy's ``hq[]`` captures the values of names from the macro definition site,
+and prepends statements that restore them to the module using the macro.
+"""
+
+from macropy.core.macros import Macros
+from macropy.core.hquotes import macros, hq, ast_literal
+
+macros = Macros()
+
+def double(x):
+    return 2 * x
+
+@macros.expr
+def twice(tree, **kw):
+    """[syntax, expr] Double the value of an expression, using a captured helper function."""
+    return hq[double(ast_literal[tree])]
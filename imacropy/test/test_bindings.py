@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Tests for imacropy.bindings (macro binding registry of the REPL consoles)."""
+
+import importlib
+import weakref
+
+from ..bindings import MacroBindings
+
+macro_module = "imacropy.test.simplelet"
+
+def main():
+    mod = importlib.import_module(macro_module)
+    b = MacroBindings()
+    assert not b
+    b.commit([(macro_module, [("let", "let")])])
+    assert macro_module in b
+    assert [(fullname, mb) for fullname, (_, mb) in b.items()] == [(macro_module, [("let", "let")])]
+    assert b.stamp(macro_module) is not None
+    assert b.snapshot() == ((macro_module, (("let", "let"),), b.stamp(macro_module)),)
+
+    try:
+        b.commit([(macro_module, [("nosuchmacro", "nosuchmacro")])])
+    except ImportError:
+        pass
+    else:
+        assert False, "expected ImportError"
+    assert [mb for _, (_, mb) in b.items()] == [[("let", "let")]]  # unchanged
+
+    # a reload supersedes the old version, which is released
+    old = weakref.ref(mod.macros)
+    oldlet = weakref.ref(mod.let)
+    assert not b.note_reload([macro_module])  # not reloaded yet, nothing new
+    mod = importlib.reload(mod)
+    assert b.note_reload([macro_module])
+    assert b.release() == 0
+    assert old() is None and oldlet() is None
+    report = b.memory_report()
+    assert report[0].startswith(f"{macro_module} (bound): version 2"), report
+    assert len(report) == 1, report
+
+    # a stale reference keeps a superseded version alive, and shows up in the report
+    f = mod.let
+    mod = importlib.reload(mod)
+    assert b.note_reload([macro_module])
+    assert b.release() == 1
+    report = b.memory_report()
+    assert report[0].startswith(f"{macro_module} (bound): version 3"), report
+    assert report[1].strip().startswith("superseded version 2 still alive"), report
+    assert report[1].endswith(", 1 stale reference"), report
+    del f
+    assert b.release() == 0
+    assert len(b.memory_report()) == 1
+
+    print("All tests PASSED")
+
+if __name__ == "__main__":
+    main()
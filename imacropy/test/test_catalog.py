@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Tests for imacropy.catalog (cached, searchable catalog of macros)."""
+
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+
+from .. import catalog, events
+
+def edit(filename, prefix):
+    """Insert `prefix` at the start of `filename`, and make sure the change is seen."""
+    with open(filename, "rt", encoding="utf-8") as f:
+        source = f.read()
+    with open(filename, "wt", encoding="utf-8") as f:
+        f.write(prefix + source)
+    st = os.stat(filename)
+    os.utime(filename, (st.st_atime, st.st_mtime + 10))
+
+def main():
+    with tempfile.TemporaryDirectory(prefix="imacropy-test-") as tmp:
+        filename = os.path.join(tmp, "catlet.py")
+        shutil.copyfile(os.path.join(os.path.dirname(__file__), "simplelet.py"), filename)
+        sys.path.insert(0, tmp)
+        try:
+            test_catalog(filename)
+        finally:
+            sys.path.remove(tmp)
+    print("All tests PASSED")
+
+def test_catalog(filename):
+    assert catalog.macros_in("catlet") == []  # not imported
+    assert catalog.macros_in("os") == []  # not a macro module
+    mod = importlib.import_module("catlet")
+
+    infos = catalog.macros_in("catlet")
+    assert [(info.name, info.module, info.kind) for info in infos] == [("let", "catlet", "expr"),
+                                                                       ("letseq", "catlet", "expr")]
+    let = infos[0]
+    assert let.summary == "[syntax, expr] Introduce local bindings, as real lexical variables."
+    assert let.filename == filename
+    lines = catalog.source_lines(let.filename, let.span)
+    assert lines[0] == "@macros.expr"
+    assert lines[1].startswith("def let(")
+    assert catalog.lookup(mod.let.__wrapped__) == (let.filename, let.span)
+
+    events.clear()
+    assert catalog.macros_in("catlet") is infos  # cached
+    assert events.events("cache")[-1].data == {"cache": "catalog", "hit": True}
+
+    # search: case-insensitive regex, against name, module and docstring summary
+    assert [info.name for info in catalog.search("LET", ["catlet"])] == ["let", "letseq"]
+    assert [info.name for info in catalog.search("^let$", ["catlet"])] == ["let"]
+    assert [info.name for info in catalog.search("sequential", ["catlet"])] == ["letseq"]
+    assert [info.name for info in catalog.search("[syntax", ["catlet"])] == ["let", "letseq"]  # literal
+    assert catalog.search("nosuchthing", ["catlet"]) == []
+
+    # after a file edit, the file is re-read; after a reload, the catalog is rebuilt
+    edit(filename, "# new line 1\n# new line 2\n")
+    lines = catalog.source_lines(let.filename, let.span)
+    assert lines[2] == "@macros.expr"  # old span, new file content
+    mod = importlib.reload(mod)
+    infos2 = catalog.macros_in("catlet")
+    assert infos2 is not infos
+    let2 = infos2[0]
+    assert let2.span == (let.span[0] + 2, let.span[1] + 2)
+    lines = catalog.source_lines(let2.filename, let2.span)
+    assert lines[0] == "@macros.expr"
+    assert lines[1].startswith("def let(")
+    assert [info.name for info in catalog.search("sequential", ["catlet"])] == ["letseq"]
+
+    # file removed
+    os.unlink(filename)
+    assert catalog.source_lines(let2.filename, let2.span) is None
+
+if __name__ == "__main__":
+    main()
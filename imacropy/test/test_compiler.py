@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Tests for imacropy.compiler (expand_and_compile and its code cache)."""
+
+import importlib
+import subprocess
+import sys
+
+from ..compiler import CodeCache, expand_and_compile, expand_and_compile_many
+
+macro_module = "imacropy.test.simplelet"
+bindings = [(macro_module, ["let"])]
+
+def main():
+    # just importing imacropy must not boot up MacroPy
+    ret = subprocess.run([sys.executable, "-c",
+                          "import sys, imacropy; assert 'macropy.activate' not in sys.modules"])
+    assert ret.returncode == 0
+
+    cache = CodeCache()
+    code = expand_and_compile("let((x, 21))[2*x]", bindings, mode="eval", cache=cache)
+    assert eval(code) == 42
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    # cache hit
+    assert expand_and_compile("let((x, 21))[2*x]", bindings, mode="eval", cache=cache) is code
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # a different mode is a different cache entry
+    code2 = expand_and_compile("let((x, 21))[2*x]", bindings, mode="exec", cache=cache)
+    assert code2 is not code
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # reloading the macro module invalidates code compiled with its old version
+    importlib.reload(sys.modules[macro_module])
+    code3 = expand_and_compile("let((x, 21))[2*x]", bindings, mode="eval", cache=cache)
+    assert code3 is not code
+    assert eval(code3) == 42
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    # LRU eviction at maxsize
+    cache = CodeCache(maxsize=2)
+    sources = [f"let((x, {k}))[x]" for k in range(3)]
+    for source in sources:
+        expand_and_compile(source, bindings, mode="eval", cache=cache)
+    assert len(cache) == 2
+    expand_and_compile(sources[2], bindings, mode="eval", cache=cache)  # most recent, still cached
+    assert cache.hits == 1
+    expand_and_compile(sources[0], bindings, mode="eval", cache=cache)  # least recent, evicted
+    assert cache.misses == 4
+    assert len(cache) == 2
+
+    # no caching
+    cache.clear()
+    expand_and_compile(sources[0], bindings, mode="eval", cache=False)
+    assert len(cache) == 0
+
+    # batch variant
+    codes = expand_and_compile_many(sources + sources[:1], bindings, mode="eval", cache=False)
+    assert [eval(c) for c in codes] == [0, 1, 2, 0]
+    assert codes[3] is codes[0]
+
+    # macros using hq[] prepend statements to the expansion; they work in all modes
+    hqbindings = [("imacropy.test.hqtwice", ["twice"])]
+    assert eval(expand_and_compile("twice[21]", hqbindings, mode="eval", cache=False)) == 42
+    assert eval(expand_and_compile("twice[x] + 1", hqbindings, mode="eval", cache=False), {"x": 10}) == 21
+    namespace = {}
+    exec(expand_and_compile("y = twice[21]", hqbindings, mode="exec", cache=False), namespace)
+    assert namespace["y"] == 42
+    exec(expand_and_compile("y = twice[y]", hqbindings, mode="single", cache=False), namespace)
+    assert namespace["y"] == 84
+
+    # eval mode requires an expression
+    try:
+        expand_and_compile("x = 42", bindings, mode="eval", cache=False)
+    except SyntaxError:
+        pass
+    else:
+        assert False, "expected SyntaxError"
+
+    # unknown macro name
+    try:
+        expand_and_compile("42", [(macro_module, ["nosuchmacro"])], cache=False)
+    except ImportError:
+        pass
+    else:
+        assert False, "expected ImportError"
+
+    print("All tests PASSED")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Tests for imacropy.console.AsyncMacroConsole."""
+
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import time
+
+from ..console import AsyncMacroConsole
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir)
+
+def run(console, source):
+    """Run `source` outside `interact`. Return what it printed."""
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        console.runsource(source)
+    return out.getvalue()
+
+def interact(console, lines, delay=0.0):
+    """Run `interact`, feeding it `lines`, waiting `delay` seconds before each. Return what it printed."""
+    lines = list(lines)
+    def raw_input(prompt=""):
+        time.sleep(delay)  # the REPL thread waits for input, while the event loop keeps running
+        if not lines:
+            raise EOFError
+        return lines.pop(0)
+    console.raw_input = raw_input
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        console.interact(banner="", exitmsg="")
+    return out.getvalue()
+
+def main():
+    # outside interact: top-level await runs to completion in the calling thread
+    m = AsyncMacroConsole()
+    assert run(m, "x = await asyncio.sleep(0, result=42)") == ""
+    assert m.locals["x"] == 42
+    assert run(m, "print(x)") == "42\n"
+    out = run(m, "1/0")
+    assert out.startswith("Traceback") and out.endswith("ZeroDivisionError: division by zero\n"), out
+    assert "console.py" not in out and "asyncio" not in out, out  # only the input's frames
+    out = run(m, "await asyncio.sleep(0, result=1/0)")
+    assert "ZeroDivisionError" in out and "asyncio" not in out, out
+
+    # inside interact: a background task keeps running while the console waits for input
+    m = AsyncMacroConsole()
+    out = interact(m, ["counter = [0]",
+                       "async def tick():",
+                       "    while True:",
+                       "        counter[0] += 1",
+                       "        await asyncio.sleep(0.01)",
+                       "",
+                       "task = asyncio.ensure_future(tick())",
+                       "n0 = counter[0]",
+                       "n1 = counter[0]",
+                       "task.cancel()",
+                       "from imacropy.test.simplelet import macros, let",
+                       "y = await asyncio.sleep(0, result=let((z, 21))[2*z])",
+                       "macros?",
+                       "let?",
+                       "1/0"],
+                   delay=0.1)
+    assert m.locals["n1"] - m.locals["n0"] >= 3, (m.locals["n0"], m.locals["n1"])
+    assert m.locals["y"] == 42
+    assert "let from imacropy.test.simplelet" in out, out
+    assert "[syntax, expr] Introduce local bindings" in out, out
+    assert "ZeroDivisionError: division by zero" in out, out
+    assert "concurrent" not in out and "console.py" not in out, out
+
+    # interact driven from a pipe, via the bootstrapper
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root] + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+    ret = subprocess.run([sys.executable, os.path.join(root, "macropy3"), "-ai"],
+                         input=b"x = await asyncio.sleep(0, result=6)\nprint(x * 7)\n",
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, timeout=60)
+    out = ret.stdout.decode()
+    assert ret.returncode == 0, out
+    assert "42" in out and "Error" not in out, out
+
+    print("All tests PASSED")
+
+if __name__ == "__main__":
+    main()
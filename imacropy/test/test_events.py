@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Tests for imacropy.events (ring buffer of macro expansion events)."""
+
+import contextlib
+import io
+import re
+import sys
+
+from .. import events
+from ..compiler import expand_and_compile
+
+def main():
+    events.clear()
+    events.record("reload", module="foo", duration=0.0015)
+    events.record("bind", module="foo", names=["let"])
+    assert [e.kind for e in events.events()] == ["reload", "bind"]
+    assert events.events("bind")[0].data == {"module": "foo", "names": ["let"]}
+
+    # dump format: time, kind, fields; durations in milliseconds
+    out = io.StringIO()
+    events.dump(file=out)
+    lines = out.getvalue().splitlines()
+    assert re.fullmatch(r"\d\d:\d\d:\d\d\.\d{6} reload module='foo' duration=1\.500ms", lines[0]), lines[0]
+    assert re.fullmatch(r"\d\d:\d\d:\d\d\.\d{6} bind module='foo' names=\['let'\]", lines[1]), lines[1]
+    out = io.StringIO()
+    events.dump(file=out, kind="nosuchkind")
+    assert out.getvalue() == "<no events recorded>\n"
+
+    # eviction at maxlen, and resize keeping the most recent events
+    try:
+        events.resize(3)
+        for k in range(5):
+            events.record("input", k=k)
+        assert [e.data["k"] for e in events.events()] == [2, 3, 4]
+        events.resize(2)
+        assert [e.data["k"] for e in events.events()] == [3, 4]
+    finally:
+        events.resize(1000)
+    assert [e.data["k"] for e in events.events()] == [3, 4]
+
+    # enable/disable
+    events.clear()
+    events.disable()
+    try:
+        events.record("input", k=0)
+        assert events.events() == []
+    finally:
+        events.enable()
+    events.record("input", k=1)
+    assert len(events.events()) == 1
+
+    # dump on uncaught exception, after the traceback
+    previous_hook = sys.excepthook
+    try:
+        out = io.StringIO()
+        events.dump_on_exception(file=out)
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            try:
+                raise ValueError("oops")
+            except ValueError as exc:
+                sys.excepthook(type(exc), exc, exc.__traceback__)
+        assert "ValueError: oops" in err.getvalue()
+        lines = out.getvalue().splitlines()
+        assert lines[0] == "Most recent macro expansion events:"
+        assert lines[1].endswith("input k=1")
+    finally:
+        sys.excepthook = previous_hook
+
+    # expansion hooks (the bootstrapper installs them, too); installing again has no effect
+    from macropy.core.macros import injected_vars, post_processing
+    events.install_expansion_hooks()
+    events.install_expansion_hooks()
+    assert injected_vars.count(events._imacropy_expand_start) == 1
+    assert post_processing.count(events._imacropy_expand_done) == 1
+    events.clear()
+    expand_and_compile("x = 1\ny = let((z, 21))[2*z]", [("imacropy.test.simplelet", ["let"])], cache=False)
+    assert events.events("expand")[-1].data["lines"] == 2  # earlier ones: importing the macro module
+
+    print("All tests PASSED")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Tests for the IPython extension imacropy.iconsole.
+
+Skipped if IPython is not installed.
+"""
+
+import contextlib
+import io
+
+try:
+    from IPython.core.interactiveshell import InteractiveShell
+except ImportError:
+    InteractiveShell = None
+
+macro_module = "imacropy.test.simplelet"
+
+def main():
+    if InteractiveShell is None:
+        print("IPython not installed, skipping")
+        return
+    shell = InteractiveShell.instance()
+    shell.config.IMacroPyExtension.preload = [macro_module]
+
+    # Loading the extension must not print anything (this breaks tools that read IPython's output).
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        shell.run_line_magic("load_ext", "imacropy.iconsole")
+    assert out.getvalue() == "", out.getvalue()
+
+    from .. import events, iconsole
+    ext = iconsole._instance
+    assert ext is not None
+    assert list(ext.preload) == [macro_module]
+
+    events.clear()
+    result = shell.run_cell(f"from {macro_module} import macros, let\n"
+                            f"x = let((y, 21))[2*y]\n")
+    assert result.success
+    inputs = events.events("input")  # the internal stub refresh cells are not counted
+    assert [e.data["lines"] for e in inputs] == [2], inputs
+    assert ext.preloader is None  # waited for the preload to finish
+    assert ext.preload_errors == []
+    assert shell.user_ns["x"] == 42
+    assert "let" in shell.user_ns  # macro stub
+    assert "let" in ext.current_stubs
+
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        shell.run_line_magic("macros", "")
+    assert out.getvalue() == f"let from {macro_module}\n"
+
+    print("All tests PASSED")
+
+if __name__ == "__main__":
+    main()
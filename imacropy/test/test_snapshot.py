@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""Tests for imacropy.snapshot, via MacroConsole and the IPython extension.
+
+The IPython part is skipped if IPython is not installed.
+"""
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+from ..console import MacroConsole
+
+try:
+    from IPython.core.interactiveshell import InteractiveShell
+except ImportError:
+    InteractiveShell = None
+
+def write_macro_modules(path):
+    """Write two macro modules, copies of `simplelet`, into directory `path`."""
+    with open(os.path.join(os.path.dirname(__file__), "simplelet.py"), "rt", encoding="utf-8") as f:
+        source = f.read()
+    for modname in ("snaplet", "snaplet2"):
+        with open(os.path.join(path, f"{modname}.py"), "wt", encoding="utf-8") as f:
+            f.write(source)
+
+def edit(path, modname):
+    """Change the source of macro module `modname` in directory `path`."""
+    filename = os.path.join(path, f"{modname}.py")
+    with open(filename, "at", encoding="utf-8") as f:
+        f.write("\n# edited\n")
+    st = os.stat(filename)
+    os.utime(filename, (st.st_atime, st.st_mtime + 10))  # make sure the change is seen
+
+def run(console, source):
+    """Run `source` in a `MacroConsole`. Return what it printed."""
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        console.runsource(source)
+    return out.getvalue()
+
+def test_console(path, snapfile):
+    m = MacroConsole()
+    inputs = ["from snaplet import macros, let",
+              "from snaplet2 import macros, let as let2",
+              "x = let((y, 21))[2*y]",
+              "w = let2((a, 1), (b, 1))[a + b]",
+              "f = let",
+              "z = 1",
+              "def g(a):\n    return 2 * a\n",
+              "class C:\n    def __init__(self):\n        self.v = let((q, 1))[q]\n",
+              "c = C()",
+              "n = g(21)"]
+    for source in inputs:
+        out = run(m, source)
+        assert out == "", out
+    assert "[syntax, expr]" in run(m, "let?")  # not recorded
+    assert "def let" in run(m, "let??")  # not recorded
+    assert run(m, "macros?") == "let from snaplet\nlet2 from snaplet2\n"  # not recorded
+    assert [entry.source for entry in m._history] == inputs
+    assert [entry.imports for entry in m._history][:2] == [(("snaplet", (("let", "let"),)),),
+                                                           (("snaplet2", (("let", "let2"),)),)]
+    # per-input module usage
+    assert [[fullname for fullname, _, _ in entry.bindings] for entry in m._history] == \
+        [[], [], ["snaplet"], ["snaplet2"], ["snaplet"], [], [], ["snaplet"], [], []]
+    out = run(m, f"macros?save {snapfile}")
+    assert "saved session" in out, out
+    assert "not saved (cannot be pickled): C, c, f, g" in out, out
+    assert len(m._history) == len(inputs)  # save command not recorded
+
+    def check(console):
+        assert (console.locals["x"], console.locals["w"], console.locals["z"], console.locals["n"]) == (42, 2, 1, 42)
+        assert console.locals["g"](2) == 4
+        assert isinstance(console.locals["c"], console.locals["C"])
+        assert console.locals["c"].v == 1
+        assert console.locals["f"] is console.locals["let"]
+
+    # restore from the saved values, reusing the saved code; inputs defining unpicklable values are run again
+    m2 = MacroConsole()
+    out = run(m2, f"macros?restore {snapfile}")
+    assert "restored 10 inputs (0 macro-expanded again)" in out, out
+    assert "ran again 4 inputs" in out, out
+    assert "restored 9 names" in out and "could not restore" not in out, out
+    check(m2)
+    assert "let" in m2.locals and "let2" in m2.locals  # macro stubs
+    assert run(m2, "v = let((y, 2))[y]") == ""  # macros are usable
+    assert m2.locals["v"] == 2
+    assert len(m2._history) == len(inputs) + 1
+
+    # replay; inputs that refer to macro stubs must work too
+    m3 = MacroConsole()
+    out = run(m3, f"macros?replay {snapfile}")
+    assert "Error" not in out, out
+    check(m3)
+    assert len(m3._history) == len(inputs)  # replayed inputs are recorded once, the command not at all
+
+    # Only the inputs that use a changed macro module, and need to be run, are macro-expanded again.
+    edit(path, "snaplet2")  # used by w, whose value was saved
+    m4 = MacroConsole()
+    out = run(m4, f"macros?restore {snapfile}")
+    assert "reloaded changed macro modules: snaplet2" in out, out
+    assert "restored 10 inputs (0 macro-expanded again)" in out, out
+    check(m4)
+    m4 = MacroConsole()
+    out = run(m4, f"macros?replay {snapfile}")
+    assert "restored 10 inputs (1 macro-expanded again)" in out, out
+    check(m4)
+    edit(path, "snaplet")  # used by x, f and C; the latter two are run when restoring
+    m5 = MacroConsole()
+    out = run(m5, f"macros?restore {snapfile}")
+    assert "restored 10 inputs (2 macro-expanded again)" in out, out
+    assert "Error" not in out, out
+    check(m5)
+    m5 = MacroConsole()
+    out = run(m5, f"macros?replay {snapfile}")
+    assert "restored 10 inputs (4 macro-expanded again)" in out, out  # snaplet2 still differs from the snapshot
+    assert "Error" not in out, out
+    check(m5)
+
+    # errors are reported, not raised
+    assert "Usage" in run(m5, "macros?save")
+    assert "FileNotFoundError" in run(m5, f"macros?restore {snapfile}.nonexistent")
+
+    # the history is bounded
+    m6 = MacroConsole()
+    m6._history = type(m6._history)(maxlen=2)
+    for source in inputs:
+        run(m6, source)
+    assert [entry.source for entry in m6._history] == inputs[-2:]
+
+def test_iconsole(path, snapfile):
+    shell = InteractiveShell.instance()
+    shell.run_line_magic("load_ext", "imacropy.iconsole")
+    from .. import iconsole
+    ext = iconsole._instance
+
+    def run_cell(source):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            result = shell.run_cell(source)
+        return result, out.getvalue()
+
+    inputs = ["from snaplet import macros, let\n",
+              "x = let((y, 21))[2*y]\ny = x + 1\n",
+              "f = let\n"]
+    for source in inputs:
+        result, _ = run_cell(source)
+        assert result.success
+    run_cell("let?")
+    run_cell("let??")
+    run_cell("%macros")
+    result, out = run_cell(f"%macros --save {snapfile}")
+    assert "saved session" in out, out
+    assert [entry.source for entry in ext.history] == inputs  # sources as strings; commands not recorded
+
+    shell.reset()
+    result, out = run_cell(f"%macros --restore {snapfile}")
+    assert "restored 3 inputs (0 macro-expanded again)" in out, out
+    assert (shell.user_ns["x"], shell.user_ns["y"]) == (42, 43)
+    assert len(ext.history) == 2 * len(inputs)
+
+    edit(path, "snaplet")
+    shell.reset()
+    ext.history.clear()
+    result, out = run_cell(f"%macros --replay {snapfile}")
+    assert "restored 3 inputs (2 macro-expanded again)" in out, out
+    assert "Error" not in out, out
+    assert (shell.user_ns["x"], shell.user_ns["y"]) == (42, 43)
+    assert shell.user_ns["f"] is shell.user_ns["let"]
+    assert [entry.source for entry in ext.history] == inputs
+
+    # a magic that compiles code of its own (%time) still makes one entry per cell
+    shell.reset()
+    ext.history.clear()
+    timed = ["from snaplet import macros, let\n",
+             "lst = []\n",
+             "%time lst.append(let((k, 1))[k])\n"]
+    for source in timed:
+        result, _ = run_cell(source)
+        assert result.success
+    assert shell.user_ns["lst"] == [1]
+    assert len(ext.history) == len(timed)  # the code %time expands is not recorded separately
+    assert "run_line_magic('time'" in ext.history[-1].source
+    result, out = run_cell(f"%macros --save {snapfile}")
+    shell.reset()
+    result, out = run_cell(f"%macros --replay {snapfile}")
+    assert "Error" not in out, out
+    assert shell.user_ns["lst"] == [1]
+
+def main():
+    with tempfile.TemporaryDirectory(prefix="imacropy-test-") as tmp:
+        sys.path.insert(0, tmp)
+        try:
+            write_macro_modules(tmp)
+            test_console(tmp, os.path.join(tmp, "session.snap"))
+            if InteractiveShell is None:
+                print("IPython not installed, skipping IPython tests")
+            else:
+                write_macro_modules(tmp)
+                test_iconsole(tmp, os.path.join(tmp, "isession.snap"))
+        finally:
+            sys.path.remove(tmp)
+    print("All tests PASSED")
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,18 @@
 __all__ = ["doc", "sourcecode"]
 
 import ast
+import hashlib
 import importlib
+import importlib.util
 import inspect
+import os
+import sys
+from time import perf_counter
 
 from macropy.core.macros import WrappedFunction
 
+from . import catalog, events
+
 def doc(obj):
     """Print an object's docstring, non-interactively.
 
@@ -22,10 +29,19 @@ def doc(obj):
 
     And that looking directly at `some_macro.__doc__` prints the string
     value as-is, without formatting it.
+
+    For macros, the definition site is looked up in `imacropy.catalog`,
+    which caches it, so repeated queries do not re-read the source file.
     """
     if not hasattr(obj, "__doc__") or not obj.__doc__:
         print("<no docstring>")
         return
+    site = _macro_definition_site(obj)
+    if site:
+        filename, (firstlineno, _) = site
+        print(f"{filename}:{firstlineno}")
+        print(inspect.cleandoc(obj.__doc__))
+        return
     try:
         if isinstance(obj, WrappedFunction):
             obj = obj.__wrapped__  # this is needed to make inspect.getsourcefile work with macros
@@ -42,7 +58,18 @@ def sourcecode(obj):
     Additionally, if the information is available, print the filename
     and the starting line number of the definition of `obj` in that file.
     This is printed before the actual source code.
+
+    For macros, the source code is served from `imacropy.catalog`.
     """
+    site = _macro_definition_site(obj)
+    if site:
+        filename, span = site
+        source = catalog.source_lines(filename, span)
+        if source is not None:
+            print(f"{filename}:{span[0]}")
+            for line in source:
+                print(line)
+            return
     try:
         if isinstance(obj, WrappedFunction):
             obj = obj.__wrapped__  # this is needed to make inspect.getsourcefile work with macros
@@ -54,19 +81,19 @@ def sourcecode(obj):
     except (TypeError, OSError):
         print("<no source code available>")
 
+def _macro_definition_site(obj):
+    """If `obj` is a macro (stub), return its definition site as in `catalog.lookup`, else `None`."""
+    if not isinstance(obj, WrappedFunction):
+        return None
+    return catalog.lookup(obj.__wrapped__)
+
 # Modeled after macropy.core.macros.detect_macros.
 # This is a separate function with duplicate logic, so we don't need to modify MacroPy.
-def _reload_macro_modules(tree, from_fullname, from_package=None, from_module=None):
-    """Walk an AST, importing and reloading any macro modules the AST says to import.
+def _macro_imports(tree, from_package=None):
+    """Return the fullnames of the macro modules `tree` imports macros from, in order.
 
     Here "macro module" means a module from which `tree` imports macro definitions,
     i.e. `somemod` in `from somemod import macros, ...`.
-
-    Reloading modules from which macro definitions are imported ensures that the
-    REPL always has access to the latest macro definitions, even if they are modified
-    on disk during the REPL session.
-
-    This is essentially an implementation detail of `imacropy`.
     """
     macro_modules = []
     for stmt in tree.body:
@@ -75,9 +102,85 @@ def _reload_macro_modules(tree, from_fullname, from_package=None, from_module=No
             stmt.names[0].asname is None):  # noqa: E129
             fullname = importlib.util.resolve_name('.' * stmt.level + stmt.module, from_package)
             macro_modules.append(fullname)
-    for fullname in macro_modules:
+    return macro_modules
+
+def _reload_macro_modules(tree, from_fullname, from_package=None, from_module=None):
+    """Walk an AST, importing and reloading any macro modules the AST says to import.
+
+    Reloading modules from which macro definitions are imported ensures that the
+    REPL always has access to the latest macro definitions, even if they are modified
+    on disk during the REPL session.
+
+    A module that is imported for the first time is not reloaded, since it is
+    already the latest version. Neither is a module preloaded by `_preload_macro_modules`,
+    the first time it is requested, if its source file has not changed since.
+
+    Return a list of the fullnames of the modules that were reloaded.
+
+    This is essentially an implementation detail of `imacropy`.
+    """
+    reloaded = []
+    for fullname in _macro_imports(tree, from_package):
+        start = perf_counter()
         try:
-            mod = importlib.import_module(fullname)
+            mod = sys.modules.get(fullname)
+            if mod is None:
+                importlib.import_module(fullname)
+                continue
+            mtime = _preloaded.pop(fullname, None)
+            if mtime is not None and mtime == _source_mtime(mod):
+                continue
             mod = importlib.reload(mod)
         except ModuleNotFoundError:
             pass
+        else:
+            events.record("reload", module=fullname, duration=perf_counter() - start)
+            reloaded.append(fullname)
+    return reloaded
+
+_preloaded = {}  # fullname -> mtime of its source file when preloaded
+
+def _preload_macro_modules(fullnames):
+    """Import macro modules ahead of time, e.g. in a background thread.
+
+    Beside importing each module, this builds its macro catalog (see `imacropy.catalog`),
+    so that later `detect_macros`, stub imports and docstring lookups find everything ready.
+    The next `_reload_macro_modules` that requests the module skips the reload,
+    unless the module's source file changes in the meantime.
+
+    Return a list of ``(fullname, exception)`` for the modules that failed to load.
+
+    This is essentially an implementation detail of `imacropy`.
+    """
+    errors = []
+    for fullname in fullnames:
+        start = perf_counter()
+        try:
+            mod = importlib.import_module(fullname)
+        except Exception as err:
+            events.record("error", module=fullname, error=repr(err))
+            errors.append((fullname, err))
+            continue
+        _preloaded[fullname] = _source_mtime(mod)
+        catalog.macros_in(fullname)
+        events.record("preload", module=fullname, duration=perf_counter() - start)
+    return errors
+
+def _source_mtime(mod):
+    """Return the mtime of the source file of module `mod`, or `None` if not available."""
+    try:
+        return os.stat(mod.__file__).st_mtime
+    except (AttributeError, TypeError, OSError):
+        return None
+
+def _source_stamp(mod):
+    """Return a version stamp for the source file of module `mod`, or `None` if not available.
+
+    The stamp is a hash of the file contents, so it stays valid across processes
+    and copies of the file, unlike an mtime.
+    """
+    try:
+        with open(mod.__file__, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (AttributeError, TypeError, OSError):
+        return None
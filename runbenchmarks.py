@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Startup time benchmarks for the macropy3 bootstrapper.
+
+Generates synthetic programs with N modules and M macro uses per module, and times:
+
+  - ``macropy3 main.py``        (scenario "file")
+  - ``macropy3 -m benchpkg.main`` (scenario "module")
+  - ``macropy3 -m benchpkg``    (scenario "package", runs ``benchpkg/__main__.py``)
+  - ``macropy3 -i``, up to the first prompt, with stdin at EOF (scenario "interactive")
+
+Each is compared against the same program with the macros pre-expanded by MacroPy,
+run with plain ``python3`` (for "interactive", plain ``python3 -i``).
+
+Cache conditions:
+
+  - "cold": each run uses a freshly generated copy of the program (no ``__pycache__``).
+    With ``--drop-caches`` (Linux, root only), the OS page cache is also dropped
+    before each run.
+  - "warm": the same copy of the program is run repeatedly, after one untimed warm-up run.
+
+The results are written as JSON, to track regressions across imacropy and MacroPy versions.
+
+Usage::
+
+    python3 runbenchmarks.py --modules 1 10 50 --uses 1 10 --repeat 5 -o bench.json
+"""
+
+import argparse
+import ast
+import functools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import import_module
+
+# https://en.wikipedia.org/wiki/ANSI_escape_code#SGR_(Select_Graphic_Rendition)_parameters
+CHEAD = "\033[32m"  # dark green
+CFAIL = "\033[91m"  # light red
+CEND = "\033[39m"   # reset FG color to default
+
+root = os.path.dirname(os.path.abspath(__file__))
+bootstrapper = os.path.join(root, "macropy3")
+macro_module = "imacropy.test.simplelet"
+
+def macro_source(nuses):
+    """Source code of one module of the synthetic program, using macros."""
+    lines = [f"from {macro_module} import macros, let", ""]
+    for j in range(nuses):
+        lines.extend([f"def f_{j}(a):",
+                      f"    return let((x, a))[x + {j}]",
+                      ""])
+    lines.extend(_run_function(nuses))
+    return "\n".join(lines)
+
+@functools.lru_cache()
+def expanded_source(nuses):
+    """Source code of one module of the synthetic program, with macros pre-expanded.
+
+    This is `macro_source`, macro-expanded by MacroPy and converted back to source code.
+    The macro import is dropped, since after expansion it only binds the macro registry,
+    so that running the result with plain ``python3`` does not import MacroPy.
+    """
+    import macropy.activate  # noqa: F401
+    from macropy.core.macros import ModuleExpansionContext, detect_macros
+
+    source = macro_source(nuses)
+    tree = ast.parse(source)
+    bindings = detect_macros(tree, "benchpkg")
+    boundmods = [(import_module(fullname), macro_bindings) for fullname, macro_bindings in bindings]
+    tree = ModuleExpansionContext(tree, source, boundmods).expand_macros()
+    tree.body = [stmt for stmt in tree.body
+                 if not (isinstance(stmt, ast.ImportFrom) and [a.name for a in stmt.names] == ["macros"])]
+    return _unparse(tree)
+
+def _unparse(tree):
+    """Convert an AST back to source code."""
+    if hasattr(ast, "unparse"):  # Python 3.9+
+        return ast.unparse(tree)
+    from macropy.core import trec, unparse
+    trec.setdefault(ast.Constant, lambda tree, i: repr(tree.value))  # MacroPy's unparser predates ast.Constant
+    return unparse(tree)
+
+def _run_function(nuses):
+    return ["def run():",
+            f"    return sum(f(j) for j, f in enumerate([{', '.join(f'f_{j}' for j in range(nuses))}]))",
+            ""]
+
+def main_source(nmodules):
+    """Source code of the main program, importing and running all modules."""
+    lines = [f"import benchpkg.mod_{i}" for i in range(nmodules)]
+    lines.extend(["",
+                  f"total = sum(m.run() for m in [{', '.join(f'benchpkg.mod_{i}' for i in range(nmodules))}])",
+                  ""])
+    return "\n".join(lines)
+
+def generate(path, nmodules, nuses, expanded):
+    """Generate the synthetic program into directory `path`."""
+    pkg = os.path.join(path, "benchpkg")
+    os.makedirs(pkg)
+    module_source = expanded_source(nuses) if expanded else macro_source(nuses)
+    files = {os.path.join(pkg, "__init__.py"): "",
+             os.path.join(pkg, "__main__.py"): main_source(nmodules),
+             os.path.join(pkg, "main.py"): main_source(nmodules),
+             os.path.join(path, "main.py"): main_source(nmodules)}
+    for i in range(nmodules):
+        files[os.path.join(pkg, f"mod_{i}.py")] = module_source
+    for filename, content in files.items():
+        with open(filename, "wt", encoding="utf-8") as f:
+            f.write(content)
+
+def command(scenario, expanded):
+    """Return the command line for running `scenario`."""
+    prefix = [sys.executable] if expanded else [sys.executable, bootstrapper]
+    if scenario == "file":
+        return prefix + ["main.py"]
+    elif scenario == "module":
+        return prefix + ["-m", "benchpkg.main"]
+    elif scenario == "package":
+        return prefix + ["-m", "benchpkg"]
+    elif scenario == "interactive":
+        return prefix + ["-i"]
+    raise ValueError(f"unknown scenario {scenario!r}")
+
+def drop_caches():
+    """Drop the OS page cache (Linux, root only)."""
+    subprocess.run(["sync"], check=True)
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+def timed_run(cmd, cwd):
+    """Run `cmd` in directory `cwd`, with stdin at EOF. Return the wall-clock time in seconds."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root] + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+    start = time.perf_counter()
+    ret = subprocess.run(cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    if ret.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)} failed in {cwd}:\n{ret.stderr.decode(errors='replace')}")
+    return elapsed
+
+def benchmark(scenario, expanded, cache, nmodules, nuses, repeat, dropcaches):
+    """Time one configuration. Return a result record (a dict)."""
+    cmd = command(scenario, expanded)
+    times = []
+    with tempfile.TemporaryDirectory(prefix="imacropy-bench-") as tmp:
+        def fresh_copy(k):
+            path = os.path.join(tmp, f"run{k}")
+            generate(path, nmodules, nuses, expanded)
+            return path
+        if cache == "warm":
+            path = fresh_copy(0)
+            timed_run(cmd, path)  # warm-up
+            for _ in range(repeat):
+                times.append(timed_run(cmd, path))
+        else:
+            for k in range(repeat):
+                path = fresh_copy(k)
+                if dropcaches:
+                    drop_caches()
+                times.append(timed_run(cmd, path))
+                shutil.rmtree(path)
+    return {"scenario": scenario,
+            "variant": "expanded" if expanded else "macropy3",
+            "cache": cache,
+            "modules": nmodules,
+            "uses": nuses,
+            "times": times,
+            "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.mean(times)}
+
+def versions():
+    """Return version information for the JSON metadata."""
+    def query(*args):
+        ret = subprocess.run([sys.executable] + list(args), cwd=root,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return ret.stdout.decode().strip() or None
+    return {"python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "imacropy": query("-c", "import imacropy; print(imacropy.__version__)"),
+            "macropy": query("-c", "import macropy; print(macropy.__version__)"),
+            "bootstrapper": query(bootstrapper, "--version")}
+
+def main():
+    parser = argparse.ArgumentParser(description="""Benchmark startup time of the macropy3 bootstrapper.""")
+    parser.add_argument('-n', '--modules', dest='modules', type=int, nargs='+', default=[1, 10],
+                        help='number of modules in the synthetic program (one or more values)')
+    parser.add_argument('-m', '--uses', dest='uses', type=int, nargs='+', default=[1, 10],
+                        help='number of macro uses per module (one or more values)')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+                        help='number of timed runs per configuration')
+    parser.add_argument('-s', '--scenario', dest='scenarios', nargs='+',
+                        choices=["file", "module", "package", "interactive"],
+                        default=["file", "module", "package", "interactive"],
+                        help='scenarios to run')
+    parser.add_argument('--drop-caches', dest='dropcaches', action="store_true", default=False,
+                        help='drop the OS page cache before each cold run (Linux, root only)')
+    parser.add_argument('-o', '--output', dest='output', type=str, default="bench.json",
+                        help='JSON file to write the results to')
+    opts = parser.parse_args()
+
+    results = []
+    for scenario in opts.scenarios:
+        # the interactive REPL does not run the program, so its size does not matter
+        sizes = [(0, 0)] if scenario == "interactive" else [(n, m) for n in opts.modules for m in opts.uses]
+        for nmodules, nuses in sizes:
+            for cache in ("cold", "warm"):
+                for expanded in (False, True):
+                    label = f"{scenario} {'expanded' if expanded else 'macropy3'} {cache} N={nmodules} M={nuses}"
+                    print(CHEAD + f"*** {label} ***" + CEND)
+                    try:
+                        r = benchmark(scenario, expanded, cache, nmodules, nuses, opts.repeat, opts.dropcaches)
+                    except (RuntimeError, OSError) as err:
+                        print(CFAIL + f"*** FAIL: {err} ***" + CEND)
+                        continue
+                    print(f"    min {r['min']:.3f}s, median {r['median']:.3f}s, mean {r['mean']:.3f}s")
+                    results.append(r)
+
+    with open(opts.output, "wt", encoding="utf-8") as f:
+        json.dump({"versions": versions(),
+                   "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                   "repeat": opts.repeat,
+                   "dropcaches": opts.dropcaches,
+                   "results": results}, f, indent=2)
+    print(CHEAD + f"*** Results written to {opts.output} ***" + CEND)
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,10 @@ import os
 import re
 import subprocess
 
-import dialects.activate
+try:  # like the bootstrapper, dialect support is optional
+    import dialects.activate  # noqa: F401
+except ImportError:
+    dialects = None
 
 # https://en.wikipedia.org/wiki/ANSI_escape_code#SGR_(Select_Graphic_Rendition)_parameters
 # https://stackoverflow.com/questions/287871/print-in-terminal-with-colors